@@ -0,0 +1,302 @@
+# local imports
+import io
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import tempfile
+
+# aiohttp is only needed by the async driver
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# quota-aware retries and pacing
+from request_scheduler import RequestScheduler
+
+# timers and counters
+from metrics import Metrics
+
+# export formats of Google formats
+import export_formats
+
+# fields shared with the synchronous client
+from google_drive import FILE_FIELDS_V2, REVISION_FIELDS_V2
+
+API_V2 = 'https://www.googleapis.com/drive/v2'
+
+# connection failures, retried like socket errors
+CONNECTION_ERRORS = (aiohttp.ClientConnectionError, aiohttp.ServerTimeoutError) if aiohttp is not None else ()
+
+class DriveRequestError(Exception):
+    '''
+    A failed Drive request, with the status and body RequestScheduler.retryable reads.
+    '''
+    def __init__(self, status, content, url):
+        super().__init__(f'{status} for url: {url}')
+        self.status = status
+        self.content = content
+
+# Google Drive class, asyncio
+class AsyncGoogleDrive(export_formats.DriveExports):
+    '''
+    The crawl and download calls of GoogleDrive (folder_contents_v2,
+    get_revisions_v2, get_shortcut_target_v2, stream_file_v2) as coroutines
+    on the Drive v2 REST API, over one pooled aiohttp session. Up to
+    `concurrency` requests are in flight at once on a single thread, paced
+    and retried by `scheduler` like GoogleDrive's calls.
+
+    Build it with from_drive() to share a GoogleDrive's credentials, quota,
+    metrics, blob cache and export formats. Large files download in one
+    stream (GoogleDrive's ranged downloads are not used). The session is
+    opened in the running loop and must be closed there (close()).
+    '''
+    def __init__(self, creds, scheduler=None, metrics=None, concurrency=1000, timeout=120, blob_cache=None, exports=None,
+                 normalize_exports=False, session=None, token_source=None):
+        if aiohttp is None and session is None:
+            raise ImportError('AsyncGoogleDrive needs aiohttp (pip install gdrive_to_git[async]).')
+        self.creds = creds
+        # a GoogleDrive's token(), whose background refresh then covers this client too
+        self.token_source = token_source
+        self.metrics = metrics or Metrics()
+        self.scheduler = scheduler or RequestScheduler(metrics=self.metrics)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.blob_cache = blob_cache  # drive_cache.BlobCache
+        self.export_formats = {**export_formats.OFFICE_FORMATS, **(exports or {})}
+        self.normalize_exports = normalize_exports
+        # a given session (e.g. fake_drive.FakeAsyncSession) is used as is and never closed
+        self.given_session = session
+        self._session = None
+        self._slots = None
+        self._refresh = None
+
+    @classmethod
+    def from_drive(cls, drive, **kwargs):
+        options = {
+            'scheduler': drive.scheduler,
+            'metrics': drive.metrics,
+            'blob_cache': drive.blob_cache,
+            'exports': drive.export_formats,
+            'normalize_exports': drive.normalize_exports,
+            'timeout': drive.timeout,
+            'token_source': drive.token
+        }
+        options.update(kwargs)
+
+        return cls(drive.creds, **options)
+
+    def session(self):
+        # created on first use, in the loop that uses it
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._refresh = asyncio.Lock()
+        if self.given_session is not None:
+            return self.given_session
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency, ttl_dns_cache=300)
+            # per connect and per read, not per request, so large downloads aren't cut off
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+        self._slots = None
+        self._refresh = None
+
+    async def token(self):
+        if self.token_source is not None:
+            return self.token_source()
+        self.session()
+        async with self._refresh:
+            if getattr(self.creds, 'expired', False) and self.creds.refresh_token:
+                # google-auth refreshes synchronously, off the loop
+                from google.auth.transport.requests import Request
+                await asyncio.to_thread(self.creds.refresh, Request())
+
+        return self.creds.token
+
+    async def fetch(self, url, params=None, headers=None, out=None):
+        # the response body, or with `out` (a path) its size and md5, the body being written there as it arrives
+        session = self.session()
+        headers = {'Authorization': f'Bearer {await self.token()}', **(headers or {})}
+        async with self._slots:
+            try:
+                async with session.get(url, params=params, headers=headers) as resp:
+                    if resp.status >= 400:
+                        raise DriveRequestError(resp.status, await resp.read(), url)
+                    if out is None:
+                        return await resp.read()
+                    size = 0
+                    md5 = hashlib.md5()
+                    with open(out, 'wb') as stream:
+                        async for chunk in resp.content.iter_chunked(1024 ** 2):
+                            stream.write(chunk)
+                            md5.update(chunk)
+                            size += len(chunk)
+                    return size, md5.hexdigest()
+            except CONNECTION_ERRORS as error:
+                raise ConnectionError(str(error)) from error
+
+    async def execute(self, method_id, path, **params):
+        # parameters as strings, None ones left out
+        params = {k: str(v).lower() if isinstance(v, bool) else str(v) for k, v in params.items() if v is not None}
+        self.metrics.count(f'api.{method_id}')
+        content = await self.scheduler.call_async(self.fetch, f'{API_V2}/{path}', params)
+
+        return json.loads(content)
+
+    async def folder_contents_v2(self, i, ignore_trashed=True):
+        q = f'"{i}" in parents '
+        if ignore_trashed:
+            q += 'and trashed = false '
+
+        files = []
+        page_token = None
+        first_pass = True
+
+        while first_pass or page_token:
+            first_pass = False
+            resp = await self.execute('drive.files.list', 'files', q=q, fields=f'nextPageToken,items({FILE_FIELDS_V2})', maxResults=1000,
+                                      pageToken=page_token)
+            files.extend(resp.get('items', []))
+            page_token = resp.get('nextPageToken')
+
+        return files
+
+    async def get_revisions_v2(self, i):
+        revisions = []
+        page_token = None
+        first_pass = True
+
+        while first_pass or page_token:
+            first_pass = False
+            try:
+                resp = await self.execute('drive.revisions.list', f'files/{i}/revisions', pageToken=page_token,
+                                          fields=f'nextPageToken,items({REVISION_FIELDS_V2})')
+            except DriveRequestError:
+                # e.g. revisions not readable: None, as GoogleDrive.get_revisions_v2
+                return None
+            revisions.extend(resp.get('items', []))
+            page_token = resp.get('nextPageToken')
+
+        return revisions
+
+    async def get_shortcut_target_v2(self, shortcut_id, target_id=None):
+        # a known target id (e.g. from a listing's shortcutDetails) saves the first lookup
+        if not target_id:
+            file = await self.execute('drive.files.get', f'files/{shortcut_id}', fields='shortcutDetails/targetId', supportsAllDrives=True)
+            target_id = file.get('shortcutDetails', {}).get('targetId', None)
+        if not target_id:
+            return None
+        try:
+            return await self.execute('drive.files.get', f'files/{target_id}', fields=FILE_FIELDS_V2, supportsAllDrives=True)
+        except DriveRequestError as error:
+            print(f"Erreur lors de la récupération du fichier cible : {error}")
+            return None
+
+    async def get_shortcut_targets_v2(self, ids, target_ids=None):
+        '''
+        get_shortcut_target_v2 of many shortcuts at once, returns {shortcut id: target or None}.
+        '''
+        target_ids = target_ids or {}
+        targets = await asyncio.gather(*(self.get_shortcut_target_v2(i, target_ids.get(i)) for i in ids))
+
+        return dict(zip(ids, targets))
+
+    async def download_url_v2(self, f, fresh=False):
+        if fresh or not self.has_links(f):
+            if f['rid']:
+                links = await self.execute('drive.revisions.get', f'files/{f["id"]}/revisions/{f["rid"]}', fields='exportLinks,downloadUrl')
+            else:
+                links = await self.execute('drive.files.get', f'files/{f["id"]}', fields='exportLinks,downloadUrl', supportsAllDrives=True)
+            self.keep_links(f, links)
+
+        return self.link_v2(f, f)
+
+    async def fetch_v2(self, f, out=None):
+        # fetch() of the download link of `f`, looked up again once if Drive turns it down (see GoogleDrive.with_link_v2)
+        listed = self.has_links(f)
+        try:
+            return await self.scheduler.call_async(self.fetch, await self.download_url_v2(f), out=out)
+        except Exception as error:
+            if not listed or not self.stale_link(error):
+                raise
+        self.metrics.count('download.stale_links')
+
+        return await self.scheduler.call_async(self.fetch, await self.download_url_v2(f, fresh=True), out=out)
+
+    def count_download(self, size):
+        self.metrics.count('download.files')
+        self.metrics.count('download.bytes', size)
+
+    async def cached_file_v2(self, f):
+        '''
+        Path of a revision in the blob cache, downloaded into it on a miss,
+        as GoogleDrive.cached_file_v2: streamed to the cache's tmp directory,
+        then added, so it never passes through memory (normalized exports
+        excepted, Drive caps exports at 10 MB).
+        '''
+        rid = self.cache_rid(f)
+        path = self.blob_cache.lookup(f['id'], rid, f.get('md5Checksum'))
+        if path is not None:
+            self.metrics.count('cache.blob.hit')
+            return path
+        self.metrics.count('cache.blob.miss')
+
+        if self.normalizes(f):
+            data = await self.fetch_v2(f)
+            self.count_download(len(data))
+            with self.blob_cache.writer(f['id'], rid) as blob:
+                blob.write(export_formats.normalize_zip(data))
+            return blob.path
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.blob_cache.root, 'tmp'))
+        os.close(fd)
+        try:
+            size, md5 = await self.fetch_v2(f, out=tmp_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.count_download(size)
+
+        return self.blob_cache.add(f['id'], rid, tmp_path, md5, size)
+
+    async def stream_file_v2(self, f, out='stream'):
+        '''
+        Content of a file or revision: bytes for out='str', a BytesIO for
+        'stream', else written to the path `out`, which is returned.
+        '''
+        if self.blob_cache is not None and f['rid']:
+            path = await self.cached_file_v2(f)
+            if out in ['stream', 'str']:
+                with open(path, 'rb') as cached:
+                    data = cached.read()
+                return data if out == 'str' else io.BytesIO(data)
+            shutil.copyfile(path, out)
+            return out
+
+        if out not in ['stream', 'str'] and not self.normalizes(f):
+            # straight to disk, not through memory
+            size, _ = await self.fetch_v2(f, out=out)
+            self.count_download(size)
+            return out
+
+        data = await self.fetch_v2(f)
+        self.count_download(len(data))
+        if self.normalizes(f):
+            data = export_formats.normalize_zip(data)
+        if out == 'str':
+            return data
+        if out == 'stream':
+            return io.BytesIO(data)
+        with open(out, 'wb') as stream:
+            stream.write(data)
+
+        return out
@@ -0,0 +1,149 @@
+'''
+Converts many Drive folders at once, one process per folder at a time.
+
+    python batch.py FOLDER_ID[=LOCAL_PATH] ... --processes 8 --prefetch 4
+
+Processes share token.json, the metadata and blob caches, and one Drive
+quota (a SharedTokenBucket). Each folder's output goes to a log file next
+to its repository, and a summary is printed at the end.
+'''
+# local imports
+import os
+import sys
+import time
+import argparse
+import traceback
+import contextlib
+import multiprocessing
+import concurrent.futures
+
+# quota-aware retries and pacing
+from request_scheduler import RequestScheduler, SharedTokenBucket
+
+# process-wide state of pool workers, set by init_worker
+worker = {}
+
+def init_worker(bucket, cache_path, blob_root, drive_factory):
+    worker.update(bucket=bucket, cache_path=cache_path, blob_root=blob_root, drive_factory=drive_factory)
+
+def default_drive(**kwargs):
+    from google_drive import GoogleDrive
+    return GoogleDrive(**kwargs)
+
+def convert(folder_id, local_path, config, options):
+    '''
+    One folder, in a pool worker: make_repo, or sync_repo with
+    options['sync']. Returns the folder's summary, failures included.
+    '''
+    from drive2git import Drive2Git
+    from drive_cache import MetadataCache, BlobCache
+
+    started = time.time()
+    summary = {'folder': folder_id, 'path': local_path, 'name': None, 'status': 'ok', 'error': None}
+    cache = MetadataCache(worker['cache_path']) if worker['cache_path'] else None
+    blob_cache = BlobCache(worker['blob_root']) if worker['blob_root'] else None
+    os.makedirs(local_path, exist_ok=True)
+    log_path = os.path.join(local_path, f'drive2git-{folder_id}.log')
+    drive = None
+    try:
+        with open(log_path, 'w') as log, contextlib.redirect_stdout(log):
+            drive = worker['drive_factory'](scheduler=RequestScheduler(bucket=worker['bucket']), blob_cache=blob_cache)
+            g = Drive2Git(drive, folder_id, local_path=local_path, config=config, workers=options.get('workers', 1),
+                          cache=cache, crawl=False, lfs_threshold=options.get('lfs_threshold'))
+            summary['name'] = g.name
+            run_options = {k: options[k] for k in ['minutes', 'prefetch', 'download_workers'] if k in options}
+            if options.get('sync'):
+                g.sync_repo(**run_options)
+            else:
+                g.make_repo(backend=options.get('backend', 'index'), resume=options.get('resume', False), **run_options)
+        summary['metrics'] = g.run_metrics.summary()
+    except Exception as exception:
+        summary['status'] = 'failed'
+        summary['error'] = f'{type(exception).__name__}: {exception}'
+        with open(log_path, 'a') as log:
+            log.write(traceback.format_exc())
+    finally:
+        if drive is not None:
+            drive.close()
+        if cache is not None:
+            cache.close()
+        if blob_cache is not None:
+            blob_cache.close()
+    summary['seconds'] = time.time() - started
+
+    return summary
+
+def convert_folders(jobs, config={}, processes=None, rate=12000 / 60, cache_path='drive_cache.sqlite', blob_root='blob_cache',
+                    drive_factory=default_drive, **options):
+    '''
+    Converts (folder id, local path) jobs on `processes` processes, all
+    within `rate` requests per second. `options` go to make_repo (minutes,
+    prefetch, download_workers, backend, resume), or sync_repo with sync=True;
+    `workers` sets crawl threads per folder, `lfs_threshold` the size of files
+    committed as LFS pointers. `drive_factory(scheduler=...,
+    blob_cache=...)` builds each process's drive (default: GoogleDrive).
+    Returns the per-folder summaries, in job order.
+    '''
+    context = multiprocessing.get_context('spawn')  # no forked sqlite or http connections
+    bucket = SharedTokenBucket(rate=rate, context=context)
+
+    if drive_factory is default_drive:
+        # one OAuth flow (or refresh) up front, workers then read token.json (and refresh it themselves)
+        drive_factory(scheduler=RequestScheduler(bucket=bucket)).close()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes or os.cpu_count(), mp_context=context, initializer=init_worker,
+                                                initargs=(bucket, cache_path, blob_root, drive_factory)) as pool:
+        futures = [pool.submit(convert, folder_id, local_path, config, options) for folder_id, local_path in jobs]
+        summaries = []
+        for (folder_id, local_path), future in zip(jobs, futures):
+            try:
+                summary = future.result()
+            except Exception as exception:
+                # the worker process itself died
+                summary = {'folder': folder_id, 'path': local_path, 'name': None, 'status': 'failed',
+                           'error': f'{type(exception).__name__}: {exception}', 'seconds': 0}
+            print_summary(summary)
+            summaries.append(summary)
+
+    failed = sum(s['status'] != 'ok' for s in summaries)
+    print(f'\n{len(summaries) - failed} folders converted, {failed} failed.')
+
+    return summaries
+
+def print_summary(summary):
+    counters = summary.get('metrics', {}).get('counters', {})
+    print(f'{summary["status"]:6} {summary["name"] or summary["folder"]:30} {summary["seconds"]:8.1f}s '
+          f'{counters.get("commits", 0):6} commits {counters.get("download.bytes", 0) / 1024 ** 2:9.1f} MB  {summary["path"]}')
+    if summary['error']:
+        print(f'       {summary["error"]}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('folders', nargs='+', help='FOLDER_ID or FOLDER_ID=LOCAL_PATH (default path: current directory)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--rate', type=float, default=12000 / 60, help='requests per second, for all processes')
+    parser.add_argument('--cache', default='drive_cache.sqlite', help='shared metadata cache ("" for none)')
+    parser.add_argument('--blobs', default='blob_cache', help='shared blob cache directory ("" for none)')
+    parser.add_argument('--name', help='default commit author name')
+    parser.add_argument('--email', help='default commit author email')
+    parser.add_argument('--tz', default='UTC')
+    parser.add_argument('--minutes', type=int, default=240)
+    parser.add_argument('--workers', type=int, default=1, help='crawl threads per folder')
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--backend', default='index', choices=['index', 'fast-import'])
+    parser.add_argument('--lfs-threshold', type=int, default=None, help='bytes from which files go to Git LFS')
+    parser.add_argument('--resume', action='store_true', help='resume interrupted make_repo runs')
+    parser.add_argument('--sync', action='store_true', help='sync_repo instead of make_repo')
+    args = parser.parse_args()
+
+    jobs = [tuple(f.split('=', 1)) if '=' in f else (f, os.getcwd()) for f in args.folders]
+    config = {k: v for k, v in {'name': args.name, 'email': args.email, 'tz': args.tz}.items() if v}
+    summaries = convert_folders(jobs, config=config, processes=args.processes, rate=args.rate, cache_path=args.cache or None,
+                                blob_root=args.blobs or None, minutes=args.minutes, workers=args.workers, prefetch=args.prefetch,
+                                download_workers=args.download_workers, backend=args.backend, resume=args.resume, sync=args.sync,
+                                lfs_threshold=args.lfs_threshold)
+    sys.exit(any(s['status'] != 'ok' for s in summaries))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+'''
+Itemize/bundle benchmark on a synthetic history, no Google account needed.
+
+    python benchmarks/bench_bundle.py --revisions 1000000
+'''
+# local imports
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import drive2git
+
+def synthetic_folder_map(revisions, per_file=10, authors=20, seed=0):
+    rnd = random.Random(seed)
+    start = datetime.datetime(2015, 1, 1)
+    files = []
+    for n in range(revisions // per_file):
+        t = start + datetime.timedelta(minutes=rnd.randint(0, 5 * 365 * 24 * 60))
+        revs = []
+        for r in range(per_file):
+            t += datetime.timedelta(minutes=rnd.expovariate(1 / 600))
+            author = rnd.randrange(authors)
+            revs.append({
+                'id': f'r{n}.{r}',
+                'modifiedDate': t.strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z',
+                'lastModifyingUser': {'displayName': f'Author {author}', 'emailAddress': f'author{author}@example.com'},
+                'md5Checksum': f'{n:016x}{r:016x}',
+                'fileSize': str(rnd.randint(1, 10 ** 6))
+            })
+        files.append({
+            'path': os.path.join('bench', f'dir{n % 100}', f'file{n}.txt'),
+            'id': f'f{n}',
+            'name': f'file{n}.txt',
+            'type': 'text/plain',
+            'createdTime': revs[0]['modifiedDate'],
+            'modifiedTime': revs[-1]['modifiedDate'],
+            'gitignore': False,
+            'revisions': revs
+        })
+
+    return {'path': 'bench', 'id': 'bench', 'name': 'bench', 'type': 'application/vnd.google-apps.folder', 'gitignore': False, 'contents': files}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--revisions', type=int, default=10 ** 6)
+    parser.add_argument('--per-file', type=int, default=10)
+    parser.add_argument('--minutes', type=int, default=240)
+    parser.add_argument('--spool', help='bundle from an on-disk RecordSpool at this path instead of memory')
+    args = parser.parse_args()
+
+    t = time.perf_counter()
+    folder_map = synthetic_folder_map(args.revisions, per_file=args.per_file)
+    print(f'generate   {time.perf_counter() - t:8.2f}s  {args.revisions} revisions')
+
+    folder = {'id': 'bench', 'title': 'bench', 'mimeType': 'application/vnd.google-apps.folder'}
+    g = drive2git.Drive2Git(None, folder, config={'name': 'Bench', 'email': 'bench@example.com', 'tz': 'US/Eastern'}, crawl=False)
+    g.folder_map = folder_map
+
+    t = time.perf_counter()
+    if args.spool:
+        g.spool = drive2git.RecordSpool(args.spool)
+        g.spool.clear()
+        for f in folder_map['contents']:
+            for revision in g.file_revisions(f, f['revisions']):
+                g.spool.add('revision', revision.to_dict(), f['id'])
+        g.spool.flush()
+        folder_map = g.folder_map = None
+        print(f'spool      {time.perf_counter() - t:8.2f}s')
+    else:
+        commits = g.itemize_revisions(folder_map)
+        print(f'itemize    {time.perf_counter() - t:8.2f}s  {len(commits)} dates')
+
+    t = time.perf_counter()
+    g.bundle_commits(args.minutes)
+    print(f'bundle     {time.perf_counter() - t:8.2f}s  {len(g.bundle)} commits (itemize included)')
+
+    t = time.perf_counter()
+    g.max_versions()
+    g.drop_unchanged()
+    report = g.plan_report(verbose=False)
+    print(f'plan       {time.perf_counter() - t:8.2f}s  {report["commits"]} commits, {report["downloads"]} downloads')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+'''
+Crawl, make_repo and sync_repo benchmark against fake_drive.FakeDrive, no
+Google account needed. Reports wall time, API calls, download throughput
+and commits per second.
+
+    python benchmarks/bench_end_to_end.py --folders 50 --files 10 --latency 0.05 --workers 8 --prefetch 4
+'''
+# local imports
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import drive2git
+import fake_drive
+import request_scheduler
+
+def phase(fake, name, fn, verbose=False):
+    calls = fake.calls.copy()
+    served = fake.bytes_served
+    t = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        fn()
+    seconds = time.perf_counter() - t
+    calls = fake.calls - calls
+
+    return {
+        'phase': name,
+        'seconds': seconds,
+        'requests': calls['requests'],
+        'calls': {k: v for k, v in calls.items() if k != 'requests'},
+        'bytes': fake.bytes_served - served
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--folders', type=int, default=20)
+    parser.add_argument('--files', type=int, default=10, help='files per folder')
+    parser.add_argument('--revisions', type=int, default=5, help='max revisions per file')
+    parser.add_argument('--docs', type=float, default=0.2, help='share of Google documents')
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per round-trip')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, default=1, help='crawl threads')
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='crawl and prefetch with AsyncGoogleDrive')
+    parser.add_argument('--backend', default='index', choices=['index', 'fast-import'])
+    parser.add_argument('--modify', type=int, default=10, help='files edited before the sync_repo phase')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='keep drive2git output')
+    args = parser.parse_args()
+
+    fake = fake_drive.FakeDrive(folders=args.folders, files=args.files, revisions=args.revisions, docs=args.docs,
+                                file_size=args.file_size, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+    # short backoffs, so injected errors measure retry overhead rather than sleeps
+    drive = fake.google_drive(scheduler=request_scheduler.RequestScheduler(base_delay=0.01, max_delay=0.5))
+    config = {'name': 'Bench', 'email': 'bench@example.com', 'tz': 'US/Eastern'}
+    local_path = tempfile.mkdtemp(prefix='bench_e2e_')
+    results = []
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            g = drive2git.Drive2Git(drive, fake.root_id, local_path=local_path, config=config, workers=args.workers, crawl=False,
+                                    async_drive=fake.async_google_drive(drive) if args.use_async else None)
+
+        results.append(phase(fake, 'crawl', g.crawl, args.verbose))
+        results.append(phase(fake, 'make_repo', lambda: g.make_repo(prefetch=args.prefetch, download_workers=args.download_workers,
+                                                                     backend=args.backend), args.verbose))
+        results[-1]['commits'] = len(g.bundle)
+
+        for file_id in list(fake.history)[:args.modify]:
+            fake.modify(file_id)
+        results.append(phase(fake, 'sync_repo', lambda: g.sync_repo(prefetch=args.prefetch, download_workers=args.download_workers),
+                             args.verbose))
+        results[-1]['commits'] = len(g.bundle)
+    finally:
+        shutil.rmtree(local_path, ignore_errors=True)
+
+    for r in results:
+        r['commits_per_second'] = r.get('commits', 0) / r['seconds']
+        r['mb_per_second'] = r['bytes'] / 1024 ** 2 / r['seconds']
+
+    if args.json:
+        print(json.dumps({'args': vars(args), 'retries': drive.scheduler.retries, 'phases': results}, indent=2))
+        return
+
+    print(f'{len(fake.items)} items, {sum(len(h) for h in fake.history.values())} revisions, {drive.scheduler.retries} retries')
+    for r in results:
+        line = f'{r["phase"]:10} {r["seconds"]:8.2f}s  {r["requests"]:6} requests'
+        if r['bytes']:
+            line += f'  {r["bytes"] / 1024 ** 2:8.1f} MB {r["mb_per_second"]:7.1f} MB/s'
+        if 'commits' in r:
+            line += f'  {r["commits"]:5} commits {r["commits_per_second"]:7.1f}/s'
+        print(line)
+        print(f'{"":10} {", ".join(f"{k} {v}" for k, v in sorted(r["calls"].items()))}')
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,359 @@
 # local imports
+import io
 import os
 import time
 import pytz
 import datetime
 import mimetypes
 import re
+import json
+import asyncio
+import shutil
+import tempfile
+import threading
+import concurrent.futures
 
 # GitPython import
 import git
+from gitdb import IStream
+
+# git fast-import writer
+from fast_import import FastImport
+
+# on-disk spool of crawl records
+from record_spool import RecordSpool
+
+# compact revision records
+from revision_record import FileInfo, Revision
+
+# timers and counters
+from metrics import Metrics
+
+# resumable make_repo
+from journal import Journal
+
+# export formats of Google formats
+import export_formats
+
+# large files as Git LFS pointers
+from lfs_store import LfsStore
+
+# Prefetching downloads for make_repo
+class DownloadPipeline:
+    '''
+    Downloads the changes of the next `depth` bundles on a pool of `workers`
+    threads while make_repo commits. Content is held in memory until written,
+    at most `max_bytes` of it (downloads included); downloads take their share
+    of that budget in bundle order, so the next change to be committed can
+    always get it. Files of `spill_bytes` or more (or more than `max_bytes`)
+    are downloaded to a temporary file instead, outside the budget.
+    '''
+    def __init__(self, drive, bundles, depth=2, workers=4, max_bytes=256 * 1024 ** 2, default_size=1024 ** 2, spill_bytes=16 * 1024 ** 2):
+        self.drive = drive
+        self.bundles = bundles
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.default_size = default_size
+        self.spill_bytes = min(spill_bytes, max_bytes)
+        self.spill_dir = tempfile.mkdtemp(prefix='drive2git-')
+        # AsyncDownloadPipeline has no pool (workers=0) and its own budget
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers else None
+        self.budget = threading.Condition()
+        self.held = 0
+        self.turn = 0  # next download allowed to take budget
+        self.tickets = 0
+        self.submitted = 0
+        self.futures = {}
+        self.unread = set()  # futures handed out by get() and not yet read or written
+        self.closed = False
+
+    def submit(self, i):
+        changes = self.bundles[i][3]
+        self.drive.prefetch_links_v2(changes)
+        futures = []
+        for change in changes:
+            futures.append(self.pool.submit(self.download, change, self.tickets))
+            self.tickets += 1
+        self.futures[i] = futures
+
+    def share(self, change, ticket):
+        '''
+        Where to download `change` (a path in spill_dir, or None to hold it in
+        memory) and the budget it takes until its real size is known.
+        '''
+        size = int(change.get('fileSize') or 0)
+        if size >= self.spill_bytes:
+            return os.path.join(self.spill_dir, str(ticket)), 0
+        return None, min(size or self.default_size, self.max_bytes)
+
+    def download(self, change, ticket):
+        # bytes, or the path of a spilled download, which holds no budget
+        spill, size = self.share(change, ticket)
+        with self.budget:
+            self.budget.wait_for(lambda: self.closed or (self.turn == ticket and self.held + size <= self.max_bytes))
+            if self.closed:
+                raise concurrent.futures.CancelledError()
+            self.held += size
+            self.turn += 1
+            self.budget.notify_all()
+
+        try:
+            data = self.drive.stream_file_v2(change, out=spill or 'str')
+        except BaseException:
+            self.release(size)
+            raise
+
+        # account for the real size once known
+        if not spill:
+            with self.budget:
+                self.held += len(data) - size
+
+        return data
+
+    def release(self, size):
+        with self.budget:
+            self.held -= size
+            self.budget.notify_all()
+
+    def get(self, i):
+        '''
+        Futures of bundle `i`'s downloads, keeping `depth` bundles queued ahead.
+        Downloads of earlier bundles that were never read or written (e.g. the
+        commit failed before) are dropped now, so they don't hold the budget.
+        '''
+        for future in list(self.unread):
+            self.discard(future)
+
+        while self.submitted < min(i + 1 + self.depth, len(self.bundles)):
+            self.submit(self.submitted)
+            self.submitted += 1
+
+        futures = self.futures.pop(i)
+        self.unread.update(futures)
+
+        return futures
+
+    def result(self, future):
+        self.unread.discard(future)
+        return future.result()
+
+    def discard(self, future):
+        try:
+            data = self.result(future)
+        except BaseException:
+            # failed downloads have already released their budget
+            return
+        if isinstance(data, str):
+            os.remove(data)
+        else:
+            self.release(len(data))
+
+    def iter_file(self, future, chunk_size=32768):
+        '''
+        Size and chunks of a download, as GoogleDrive.iter_file_v2. The caller
+        consumes the content right away, so its budget is freed now.
+        '''
+        data = self.result(future)
+        if not isinstance(data, str):
+            self.release(len(data))
+            return len(data), [data]
+
+        def chunks():
+            try:
+                with open(data, 'rb') as spilled:
+                    while True:
+                        chunk = spilled.read(chunk_size)
+                        if not chunk:
+                            return
+                        yield chunk
+            finally:
+                os.remove(data)
+        return os.path.getsize(data), chunks()
+
+    def write(self, future, out):
+        data = self.result(future)
+        if isinstance(data, str):
+            shutil.move(data, out)
+            return
+        try:
+            with open(out, 'wb') as f:
+                f.write(data)
+        finally:
+            self.release(len(data))
+
+    def close(self):
+        with self.budget:
+            self.closed = True
+            self.budget.notify_all()
+        for futures in self.futures.values():
+            for future in futures:
+                future.cancel()
+        self.pool.shutdown(wait=True)
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+# Prefetching downloads for make_repo, asyncio
+class AsyncDownloadPipeline(DownloadPipeline):
+    '''
+    DownloadPipeline on an async_google_drive.AsyncGoogleDrive: downloads
+    are coroutines on an event loop thread, all of the next `depth` bundles
+    in flight at once (up to the drive's concurrency) instead of one per
+    worker thread, within the same `max_bytes` budget taken in bundle order.
+    '''
+    def __init__(self, drive, bundles, depth=2, max_bytes=256 * 1024 ** 2, default_size=1024 ** 2, spill_bytes=16 * 1024 ** 2):
+        super().__init__(drive, bundles, depth=depth, workers=0, max_bytes=max_bytes, default_size=default_size, spill_bytes=spill_bytes)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.budget = asyncio.Condition()
+
+    def run(self, coroutine):
+        # runs on the loop thread, the returned concurrent future is waited from here
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def submit(self, i):
+        futures = []
+        for change in self.bundles[i][3]:
+            futures.append(self.run(self.download(change, self.tickets)))
+            self.tickets += 1
+        self.futures[i] = futures
+
+    async def download(self, change, ticket):
+        spill, size = self.share(change, ticket)
+        async with self.budget:
+            await self.budget.wait_for(lambda: self.closed or (self.turn == ticket and self.held + size <= self.max_bytes))
+            if self.closed:
+                raise concurrent.futures.CancelledError()
+            self.held += size
+            self.turn += 1
+            self.budget.notify_all()
+
+        try:
+            data = await self.drive.stream_file_v2(change, out=spill or 'str')
+        except BaseException:
+            await self.release_async(size)
+            raise
+
+        # account for the real size once known
+        if not spill:
+            async with self.budget:
+                self.held += len(data) - size
+
+        return data
+
+    async def release_async(self, size):
+        async with self.budget:
+            self.held -= size
+            self.budget.notify_all()
+
+    def release(self, size):
+        self.run(self.release_async(size)).result()
+
+    async def shutdown(self):
+        async with self.budget:
+            self.closed = True
+            self.budget.notify_all()
+        await self.drive.close()
+
+    def close(self):
+        for futures in self.futures.values():
+            for future in futures:
+                future.cancel()
+        self.run(self.shutdown()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
 
 # Google Drive to Git class
 class Drive2Git:
-    def __init__(self, drive, folder, local_path=os.getcwd(), config={}, ignore_folders=[], ignore_files=[]):
+    def __init__(self, drive, folder, local_path=os.getcwd(), config={}, ignore_folders=[], ignore_files=[], workers=1, cache=None, crawl=True, spool=None, metrics=None,
+                 listing='folders', lfs_threshold=None, lfs_types=[], async_drive=None, owns_drive=False):
         self.drive = drive
+        # with owns_drive, close() closes the drive too (stopping its token refresher)
+        self.owns_drive = owns_drive
+        # crawls and prefetches downloads with asyncio if given (async_google_drive.AsyncGoogleDrive)
+        self.async_drive = async_drive
+        self.cache = cache  # drive_cache.MetadataCache
+        # shared with the drive by default, so one summary covers the run
+        self.metrics = metrics or getattr(drive, 'metrics', None) or Metrics()
+        # each make_repo or sync_repo reports from here (crawl included), see write_metrics
+        self.run_mark = self.metrics.mark()
+        self.run_metrics = None
         self.folder = self.check_object(folder)
         self.local_path = local_path
         self.config = self.load_config(config)
         self.ignore_folders = ignore_folders
         self.ignore_files = ignore_files
-        self.folder_map = self.map_folder_v2(folder)
-        self.name = self.folder_map['path']
+        self.workers = workers
+        self.listing = listing  # 'folders' (one query per folder) or 'corpus' (see load_corpus_v2)
+        self.corpus_children = None
+        self.corpus_items = None
+        self.page_token = None
+        self.folder_map = None
+        self.spool = RecordSpool(spool) if isinstance(spool, str) else spool
+        self.crawled = False
+        self.last_revisions = {}  # file id: last planned revision, see bundle_commits
+        self.journal = None  # set while make_repo writes commits
+        self.name = self.folder['title']
+        # files of lfs_threshold bytes or more, or of lfs_types, are committed as LFS pointers
+        self.lfs = None
+        if lfs_threshold is not None or lfs_types:
+            self.lfs = LfsStore(os.path.join(self.local_path, self.name, '.git', 'lfs'), lfs_threshold, lfs_types)
+        self.lfs_paths = set()
+        self.lfs_changed = False  # paths the .gitattributes doesn't have yet
+        if crawl:
+            self.crawl()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.owns_drive and self.drive is not None:
+            self.drive.close()
+
+    def crawl(self):
+        with self.metrics.phase('crawl'):
+            # taken first, so changes made during the crawl are seen by the next sync_repo
+            self.page_token = self.drive.get_start_page_token_v2()
+            if self.listing == 'corpus':
+                self.load_corpus_v2()
+            if self.spool is not None:
+                # records go to disk as they arrive instead of into folder_map
+                self.spool.clear()
+                for kind, record, parent in self.iter_folder_v2(self.folder):
+                    self.spool.add(kind, record.to_dict() if kind == 'revision' else record, parent)
+                self.spool.flush()
+            elif self.async_drive is not None:
+                self.folder_map = asyncio.run(self.crawl_async())
+            elif self.workers > 1:
+                self.folder_map = self.map_folder_v2_parallel(self.folder, workers=self.workers)
+            elif self.corpus_children is not None:
+                # folders cost no requests now, so revisions are batched across the whole tree
+                pending = []
+                self.folder_map = self.map_folder_v2(self.folder, pending=pending)
+                self.fill_revisions_v2(pending)
+            else:
+                self.folder_map = self.map_folder_v2(self.folder)
+        self.crawled = True
+
+    def load_corpus_v2(self):
+        '''
+        Lists the whole corpus (the root's shared drive, else the user's) in
+        a few large pages and indexes it by parent, so folder listings need no
+        request. The crawl from the root then keeps only its subtree, minus
+        ignored folders. Pays off for deep trees of small folders; for a small
+        folder in a large Drive, per-folder listing is cheaper.
+        '''
+        print('Listing the whole corpus.')
+        items = self.drive.list_all_v2(drive_id=self.folder.get('driveId'))
+        self.corpus_items = {item['id']: item for item in items}
+        self.corpus_children = {}
+        for item in items:
+            for parent in item.get('parents') or []:
+                self.corpus_children.setdefault(parent['id'], []).append(item)
     
     def check_object(self, obj):
         # check case: id
@@ -111,62 +445,322 @@ class Drive2Git:
                 
         return out
     
-    def map_folder_v2(self, folder, path=''):
+    def list_folder_v2(self, folder):
         '''
-        Recursive.
+        Folder contents with shortcuts resolved to their targets.
+        '''
+        contents = self.cached_listing(folder)
+        if contents is not None:
+            return contents
+
+        if self.corpus_children is not None:
+            contents = self.corpus_children.get(folder['id'], [])
+        else:
+            contents = self.drive.folder_contents_v2(folder['id'])
+
+        # resolve all shortcuts of the folder in one batch
+        targets, unknown = self.shortcut_targets(contents)
+        if unknown:
+            targets.update(self.drive.get_shortcut_targets_v2_batch(list(unknown), target_ids=unknown))
+
+        return self.resolve_listing(folder, contents, targets)
+
+    async def list_folder_v2_async(self, folder):
+        '''
+        list_folder_v2 on the async drive.
+        '''
+        contents = self.cached_listing(folder)
+        if contents is not None:
+            return contents
+
+        if self.corpus_children is not None:
+            contents = self.corpus_children.get(folder['id'], [])
+        else:
+            contents = await self.async_drive.folder_contents_v2(folder['id'])
+
+        # resolve all shortcuts of the folder at once
+        targets, unknown = self.shortcut_targets(contents)
+        if unknown:
+            targets.update(await self.async_drive.get_shortcut_targets_v2(list(unknown), target_ids=unknown))
+
+        return self.resolve_listing(folder, contents, targets)
+
+    def cached_listing(self, folder):
+        if self.cache is None:
+            return None
+        contents = self.cache.get_listing(folder['id'])
+        self.metrics.count('cache.listing.hit' if contents is not None else 'cache.listing.miss')
+
+        return contents
+
+    def shortcut_targets(self, contents):
+        '''
+        Targets of a listing's shortcuts already known (from the corpus), and
+        {shortcut id: target id} of those still to look up.
+        '''
+        shortcuts = [c for c in contents if c['mimeType'] == 'application/vnd.google-apps.shortcut']
+        target_ids = {c['id']: c.get('shortcutDetails', {}).get('targetId') for c in shortcuts}
+        targets = {}
+        if self.corpus_items is not None:
+            # targets inside the corpus are already known
+            targets = {i: self.corpus_items[t] for i, t in target_ids.items() if t in self.corpus_items}
+
+        return targets, {i: t for i, t in target_ids.items() if i not in targets}
+
+    def resolve_listing(self, folder, contents, targets):
+        # shortcuts replaced by their targets (dropped if unreadable), then cached
+        resolved = []
+        for content in contents:
+            if content['mimeType'] == 'application/vnd.google-apps.shortcut':
+                content = targets.get(content['id'])
+                if content is None:
+                    continue
+            resolved.append(content)
+
+        if self.cache is not None:
+            self.cache.put_listing(folder['id'], resolved)
+
+        return resolved
+
+    async def fill_revisions_v2_async(self, files):
+        '''
+        fill_revisions_v2 on the async drive, one request per file, all at once.
+        '''
+        missing = self.cached_revisions(files)
+        revisions = await asyncio.gather(*(self.async_drive.get_revisions_v2(f['id']) for f in missing))
+        for f, r in zip(missing, revisions):
+            f['revisions'] = r
+        self.cache_revisions(missing)
+
+    async def map_folder_v2_async(self, folder, path=''):
+        '''
+        Recursive. Same output as map_folder_v2, with the listings of all
+        subfolders and the revisions of all files of a folder requested
+        concurrently, so the whole tree is fetched at the drive's concurrency.
         '''
-        # check if id used
-        folder = self.check_object(folder)
-        
         # if root, set path to folder title
         if path == '':
             path = folder['title']
 
         # scan contents
         contents = []
-        for content in self.drive.folder_contents_v2(folder['id']):
-            originalContent = content
-            if content['mimeType'] == 'application/vnd.google-apps.shortcut':
-                originalContent = self.drive.get_shortcut_target_v2(content['id'])
+        files = []
+        subfolders = []
+        for content in await self.list_folder_v2_async(folder):
+            validContentName = self.ensure_filepath(content['title'], content['mimeType'])
 
-            validContentName = self.ensure_filepath(originalContent['title'], originalContent['mimeType'])
-
-            if originalContent['mimeType'] == 'application/vnd.google-apps.folder':
+            if content['mimeType'] == 'application/vnd.google-apps.folder':
                 if not self.check_ignore(validContentName, self.ignore_folders):
-                    p = os.path.join(path, validContentName)
-                    contents.append(self.map_folder_v2(originalContent, path=p))
+                    subfolders.append(self.map_folder_v2_async(content, path=os.path.join(path, validContentName)))
+                    contents.append(len(subfolders) - 1)
             else:
-                contentModifyingUserDict = originalContent.get('lastModifyingUser') or {}
-                contentModifyingUserName = contentModifyingUserDict.get('displayName') or originalContent.get('lastModifyingUserName')
-                contentModifyingUserEmail = contentModifyingUserDict.get('emailAddress')
-                
-                f = {
-                    'path': os.path.join(path, validContentName),
-                    'id': originalContent['id'],
-                    'name': validContentName,
-                    'type': originalContent['mimeType'],
-                    'createdTime': originalContent['createdDate'],
-                    'modifiedTime': originalContent['modifiedDate'],
-                    'gitignore': self.check_ignore(folder['title'], self.ignore_folders) | self.check_ignore(validContentName, self.ignore_files),
-                    'revisions': self.drive.get_revisions_v2(originalContent['id']),
-                    'exportLinks': originalContent.get('exportLinks'),
-                    'modifyingUserName': contentModifyingUserName,
-                    'modifyingUserEmail': contentModifyingUserEmail
-                }
+                f = self.file_entry(folder, content, path)
                 contents.append(f)
-                
+                files.append(f)
+
+        entries = await asyncio.gather(self.fill_revisions_v2_async(files), *subfolders)
+        contents = [entries[1 + c] if isinstance(c, int) else c for c in contents]
+
         # set up output dictionary
-        out = {
+        return self.folder_entry(folder, path, contents)
+
+    async def crawl_async(self):
+        try:
+            return await self.map_folder_v2_async(self.check_object(self.folder))
+        finally:
+            await self.async_drive.close()
+
+    def fill_revisions_v2(self, files):
+        '''
+        Fetches the revisions of file entries in batches, skipping files
+        unchanged since they were cached.
+        '''
+        missing = self.cached_revisions(files)
+        if missing:
+            revisions = self.drive.get_revisions_v2_batch([f['id'] for f in missing])
+            for f in missing:
+                f['revisions'] = revisions[f['id']]
+            self.cache_revisions(missing)
+
+    def cached_revisions(self, files):
+        # fills revisions from the cache, returns the entries still without them
+        missing = []
+        for f in files:
+            if self.cache is not None:
+                f['revisions'] = self.cache.get_revisions(f['id'], f['modifiedTime'])
+            if f['revisions'] is None:
+                missing.append(f)
+        if self.cache is not None:
+            self.metrics.count('cache.revisions.hit', len(files) - len(missing))
+            self.metrics.count('cache.revisions.miss', len(missing))
+
+        return missing
+
+    def cache_revisions(self, files):
+        # a failed lookup (None) is tried again on the next crawl
+        if self.cache is None:
+            return
+        for f in files:
+            if f['revisions'] is not None:
+                self.cache.put_revisions(f['id'], f['modifiedTime'], f['revisions'])
+
+    def folder_entry(self, folder, path, contents=None):
+        return {
             'path': path,
             'id': folder['id'],
             'name': folder['title'],
             'type': folder['mimeType'],
             'gitignore': self.check_ignore(folder['title'], self.ignore_folders),
-            'contents': contents
+            'contents': contents if contents is not None else []
+        }
+
+    def file_entry(self, folder, content, path, revisions=None):
+        contentModifyingUserDict = content.get('lastModifyingUser') or {}
+        contentModifyingUserName = contentModifyingUserDict.get('displayName') or content.get('lastModifyingUserName')
+        contentModifyingUserEmail = contentModifyingUserDict.get('emailAddress')
+        validContentName = self.ensure_filepath(content['title'], content['mimeType'])
+
+        return {
+            'path': os.path.join(path, validContentName),
+            'id': content['id'],
+            'name': validContentName,
+            'type': content['mimeType'],
+            'createdTime': content['createdDate'],
+            'modifiedTime': content['modifiedDate'],
+            'gitignore': self.check_ignore(folder['title'], self.ignore_folders) | self.check_ignore(validContentName, self.ignore_files),
+            'revisions': revisions,
+            'exportLinks': content.get('exportLinks'),
+            'downloadUrl': content.get('downloadUrl'),
+            'modifyingUserName': contentModifyingUserName,
+            'modifyingUserEmail': contentModifyingUserEmail,
+            'md5Checksum': content.get('md5Checksum'),
+            'fileSize': content.get('fileSize')
         }
+
+    def map_folder_v2(self, folder, path='', pending=None):
+        '''
+        Recursive. File entries are added to `pending` without revisions if
+        given, for the caller to fill them in fewer batches.
+        '''
+        # check if id used
+        folder = self.check_object(folder)
+        
+        # if root, set path to folder title
+        if path == '':
+            path = folder['title']
+
+        # scan contents
+        contents = []
+        files = []
+        for content in self.list_folder_v2(folder):
+            validContentName = self.ensure_filepath(content['title'], content['mimeType'])
+
+            if content['mimeType'] == 'application/vnd.google-apps.folder':
+                if not self.check_ignore(validContentName, self.ignore_folders):
+                    p = os.path.join(path, validContentName)
+                    contents.append(self.map_folder_v2(content, path=p, pending=pending))
+            else:
+                f = self.file_entry(folder, content, path)
+                contents.append(f)
+                files.append(f)
+
+        if pending is not None:
+            pending.extend(files)
+        elif files:
+            self.fill_revisions_v2(files)
                 
-        return out
+        # set up output dictionary
+        return self.folder_entry(folder, path, contents)
+
+    def map_folder_v2_parallel(self, folder, path='', workers=8):
+        '''
+        Same output as map_folder_v2, but folder listings and revision lists are
+        fetched by a pool of at most `workers` threads while the tree is
+        assembled here, in listing order.
+        '''
+        # check if id used
+        folder = self.check_object(folder)
+
+        # if root, set path to folder title
+        if path == '':
+            path = folder['title']
+
+        root = self.folder_entry(folder, path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            # future -> (kind, node to fill, folder object)
+            pending = {pool.submit(self.list_folder_v2, folder): ('folder', root, folder)}
+            while pending:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    kind, node, obj = pending.pop(future)
+                    if kind == 'revisions':
+                        future.result()
+                        continue
+
+                    files = []
+                    for content in future.result():
+                        validContentName = self.ensure_filepath(content['title'], content['mimeType'])
+
+                        if content['mimeType'] == 'application/vnd.google-apps.folder':
+                            if not self.check_ignore(validContentName, self.ignore_folders):
+                                child = self.folder_entry(content, os.path.join(node['path'], validContentName))
+                                node['contents'].append(child)
+                                pending[pool.submit(self.list_folder_v2, content)] = ('folder', child, content)
+                        else:
+                            f = self.file_entry(obj, content, node['path'])
+                            node['contents'].append(f)
+                            files.append(f)
+
+                    # one batched revisions task per folder
+                    if files:
+                        pending[pool.submit(self.fill_revisions_v2, files)] = ('revisions', files, None)
+
+        return root
     
+    def iter_folder_v2(self, folder, path='', parent=None):
+        '''
+        Recursive generator. The crawl of map_folder_v2 as flat (kind, record,
+        parent id) tuples in the same order: 'folder' and 'file' records
+        without nested contents or revisions, each file followed by its
+        'revision' records. Only one folder's listing is held at a time.
+        '''
+        # check if id used
+        folder = self.check_object(folder)
+
+        # if root, set path to folder title
+        if path == '':
+            path = folder['title']
+
+        entry = self.folder_entry(folder, path)
+        del entry['contents']
+        yield 'folder', entry, parent
+
+        # scan contents, revisions fetched per folder
+        items = []
+        files = []
+        for content in self.list_folder_v2(folder):
+            validContentName = self.ensure_filepath(content['title'], content['mimeType'])
+
+            if content['mimeType'] == 'application/vnd.google-apps.folder':
+                if not self.check_ignore(validContentName, self.ignore_folders):
+                    items.append((content, os.path.join(path, validContentName)))
+            else:
+                f = self.file_entry(folder, content, path)
+                items.append((f, None))
+                files.append(f)
+
+        if files:
+            self.fill_revisions_v2(files)
+
+        for item, p in items:
+            if p is not None:
+                yield from self.iter_folder_v2(item, path=p, parent=folder['id'])
+            else:
+                revisions = item.pop('revisions')
+                yield 'file', item, folder['id']
+                for revision in self.file_revisions(item, revisions):
+                    yield 'revision', revision, item['id']
+
     def create_folders(self, folder_map):
         '''
         Recursive.
@@ -189,133 +783,199 @@ class Drive2Git:
             for name in dirs:
                 os.rmdir(os.path.join(root, name))
     
-    def itemize_revisions(self, folder_map, revisions={}):
+    def file_revisions(self, content, revisions):
         '''
-        Recursive.
+        Generator of a file's revision records, in version order.
         '''
+        contentRevisions =  revisions or [None]
+
+        if len(contentRevisions) >= 100:
+            print(f'Warning: maximum number of Google Drive revisions used or exceeded by {content["name"]}.')
+
+        contentModifyingUserName = content.get('modifyingUserName')
+        contentModifyingUserEmail = content.get('modifyingUserEmail')
+        file = FileInfo(content['path'], content['type'], content['id'], content['name'], content['gitignore'], content['createdTime'])
+        for i, r in enumerate(contentRevisions):
+            validRevisionDict = r or {}
+            revisionModifyingUserDict = validRevisionDict.get('lastModifyingUser') or {}
+            revisionModifyingUserName = revisionModifyingUserDict.get('displayName') or validRevisionDict.get('lastModifyingUserName')
+            revisionModifyingUserEmail = revisionModifyingUserDict.get('emailAddress')
+
+            revisionModifiedTime = validRevisionDict.get('modifiedDate') or validRevisionDict.get('modifiedTime') or content['modifiedTime']
+            source = validRevisionDict if r else content
+
+            yield Revision(file, validRevisionDict.get('id'), i + 1,
+                           revisionModifyingUserName or contentModifyingUserName,
+                           revisionModifyingUserEmail or contentModifyingUserEmail,
+                           revisionModifiedTime,
+                           md5Checksum=source.get('md5Checksum'),
+                           fileSize=source.get('fileSize'),
+                           exportLinks=source.get('exportLinks'),
+                           downloadUrl=source.get('downloadUrl'))
+
+    def itemize_revisions(self, folder_map, revisions=None, seen=None):
+        '''
+        Recursive. Revisions grouped by modified date, each (file id, revision
+        id) once.
+        '''
+        if revisions is None:
+            revisions = {}
+        if seen is None:
+            seen = set()
+
         for content in folder_map['contents']:
             if content['type'] == 'application/vnd.google-apps.folder':
-                revisions = self.itemize_revisions(content, revisions=revisions)
+                revisions = self.itemize_revisions(content, revisions=revisions, seen=seen)
             else:
                 if 'revisions' in content.keys():
-                    contentRevisions =  content['revisions'] or [None]
-
-                    if len(contentRevisions) >= 100:
-                        print(f'Warning: maximum number of Google Drive revisions used or exceeded by {content["name"]}.')
-
-                    contentModifyingUserName = content.get('modifyingUserName')
-                    contentModifyingUserEmail = content.get('modifyingUserEmail')
-                    for i, r in enumerate(contentRevisions):
-                        validRevisionDict = r or {}
-                        revisionModifyingUserDict = validRevisionDict.get('lastModifyingUser') or {}
-                        revisionModifyingUserName = revisionModifyingUserDict.get('displayName') or validRevisionDict.get('lastModifyingUserName')
-                        revisionModifyingUserEmail = revisionModifyingUserDict.get('emailAddress')
-
-                        revisionModifiedTime = validRevisionDict.get('modifiedDate') or validRevisionDict.get('modifiedTime') or content['modifiedTime']
-
-                        revision = {
-                            'path': content['path'],
-                            'type': content['type'],
-                            'id': content['id'],
-                            'rid': validRevisionDict.get('id'),
-                            'name': content['name'],
-                            'gitignore': content['gitignore'],
-                            'version': i + 1,
-                            'authorName': revisionModifyingUserName or contentModifyingUserName,
-                            'authorEmail': revisionModifyingUserEmail or contentModifyingUserEmail,
-                            'createdTime': content['createdTime'],
-                            'modifiedTime': revisionModifiedTime
-                        }
-                        k = revisionModifiedTime
-                        v = revisions.get(k, [])
-                        if revision['rid'] not in [i['rid'] for i in v]:  # avoids duplicates if rerun
-                            v.append(revision)
-                            revisions.update({k: v})
+                    for revision in self.file_revisions(content, content['revisions']):
+                        key = (revision.id, revision.rid, revision.modifiedTime)
+                        if key not in seen:  # avoids duplicates if rerun
+                            seen.add(key)
+                            revisions.setdefault(revision.modifiedTime, []).append(revision)
 
         return revisions
     
-    def bundle_commits(self, minutes=240):
-        # get commits
-        commits = self.itemize_revisions(self.folder_map)
-        dates = sorted(commits)
+    def sweep_bundles(self, records, minutes):
+        '''
+        Generator over (date, revision) records sorted by date, in a single
+        sweep: each distinct date is parsed once, and a gap of `minutes` or
+        more closes the current bundle.
+        '''
+        gap = minutes * 60
+        epoch = datetime.datetime(1970, 1, 1)
+        fromisoformat = datetime.datetime.fromisoformat
 
-        # set time zones
-        utc = self.config['utc']
-        tz = self.config['tz']
+        group = []
+        last_date, last_seconds = None, None
+        for rdate, revision in records:
+            if rdate != last_date:
+                seconds = (fromisoformat(rdate[:-1]) - epoch).total_seconds()
+                if group and seconds - last_seconds >= gap:
+                    yield from self.author_bundles(last_date, group)
+                    group = []
+                last_date, last_seconds = rdate, seconds
+            group.append(revision)
 
-        # initialize variables
-        bundles = {}
-        rdates = []
-        cdates = []
-        comms = []
-
-        # loop through sorted dates
-        while len(dates) > 0:
-            rdate = dates.pop(0)  # oldest -> newest
-            parsed_date = datetime.datetime.strptime(rdate, '%Y-%m-%dT%H:%M:%S.%fZ')
-            cdate = utc.localize(parsed_date).astimezone(tz)
-            com = commits.get(rdate)
-
-            # existing bundle
-            if len(cdates) > 0:
-                # within bundle threshold
-                if (cdate - cdates[-1]).total_seconds() / 60 < minutes:  # time from previous edit
-                    # grow bundle
-                    rdates.append(rdate)
-                    cdates.append(cdate)
-                    comms += com  # extend list
-                else:
-                    # append previous bundle
-                    bundles.update({rdates[-1]: {
-                        'cdate': cdates[-1],
-                        'rdates': rdates,
-                        'files': comms
-                    }})
-                    
-                    # start new bundle
-                    rdates = [rdate]
-                    cdates = [cdate]
-                    comms = com
-                if len(dates) == 0:
-                    # append final bundle
-                    bundles.update({rdates[-1]: {
-                        'cdate': cdates[-1],
-                        'rdates': rdates,
-                        'files': comms
-                    }})
-            else:
-                # start new bundle
-                rdates = [rdate]
-                cdates = [cdate]
-                comms = com
+        if group:
+            yield from self.author_bundles(last_date, group)
 
-        date_sorted_bundles = dict(sorted(bundles.items()))
+    def author_bundles(self, last_date, revisions):
+        # committed on the bundle's last date, one commit per author
+        parsed_date = datetime.datetime.strptime(last_date, '%Y-%m-%dT%H:%M:%S.%fZ')
+        cdate = self.config['utc'].localize(parsed_date).astimezone(self.config['tz'])
 
-        self.bundle = []
-        for last_rdate, bundle in date_sorted_bundles.items():
-            cdate   = bundle['cdate']
-            revs    = bundle['files']
-            per_author = {}
-            for rev in revs:
-                name  = rev.get('authorName')  or self.config['author'].name
-                email = rev.get('authorEmail') or self.config['author'].email
-                per_author.setdefault((name, email), []).append(rev)
-            for (name, email), author_revs in per_author.items():
-                self.bundle.append((cdate, name, email, author_revs))
+        per_author = {}
+        for rev in revisions:
+            name  = rev.authorName  or self.config['author'].name
+            email = rev.authorEmail or self.config['author'].email
+            per_author.setdefault((name, email), []).append(rev)
+        for (name, email), author_revs in per_author.items():
+            yield (cdate, name, email, author_revs)
+
+    def bundle_commits(self, minutes=240, folder_map=None):
+        # get commits, oldest -> newest
+        if folder_map is None and self.spool is not None:
+            files = {}
+            records = ((rdate, Revision.from_dict(rev, files)) for rdate, rev in self.spool.revisions())
+        else:
+            with self.metrics.phase('itemize'):
+                commits = self.itemize_revisions(folder_map or self.folder_map)
+            records = ((rdate, rev) for rdate in sorted(commits) for rev in commits[rdate])
+
+        with self.metrics.phase('bundle'):
+            self.last_revisions = {}
+            self.bundle = list(self.sweep_bundles(self.track_last_revisions(records), minutes))
+
+    def track_last_revisions(self, records):
+        '''
+        Passes date-sorted records through, keeping the last revision id and
+        date of each file, which sync_repo later filters the file's revisions
+        against (including revisions dropped from the plan as unchanged).
+        '''
+        for rdate, revision in records:
+            self.last_revisions[revision.id] = {'rid': revision.rid, 'modified': rdate}
+            yield rdate, revision
     
     def max_versions(self):
-        for i, (cdate, author_name, author_email, changes) in enumerate(self.bundle):
+        # only the last version of each file in a commit is downloaded, the one written last
+        for n, (cdate, author_name, author_email, changes) in enumerate(self.bundle):
             max_versions = {}
             for c in changes:
-                i = max_versions.get(c['id'], {})
-                if len(i) == 0:
-                    max_versions.update({c['id']: c})
+                i = max_versions.get(c.id)
+                if i is None:
+                    max_versions[c.id] = c
                 else:
-                    if c['version'] > i['version']:
-                        max_versions.update({c['id']: c})
+                    if (c.modifiedTime, c.version) > (i.modifiedTime, i.version):
+                        max_versions[c.id] = c
 
-            changes = list(max_versions.values())
+            self.bundle[n] = (cdate, author_name, author_email, list(max_versions.values()))
+
+    def plan_commits(self, minutes=240, folder_map=None, committed=None):
+        '''
+        Bundles reduced to the downloads each commit needs: the last version of
+        each file, minus content already committed. Returns the last checksum
+        per file id (see drop_unchanged).
+        '''
+        self.bundle_commits(minutes, folder_map=folder_map)
+        with self.metrics.phase('plan'):
+            self.max_versions()
+            return self.drop_unchanged(committed)
 
+    def plan_report(self, verbose=True):
+        '''
+        Planned commits, downloads and estimated bytes of self.bundle. Google
+        formats are exported on download, so their size is unknown in advance.
+        '''
+        plan = []
+        for i, (cdate, author_name, author_email, changes) in enumerate(self.bundle):
+            known = [int(c['fileSize']) for c in changes if c.get('fileSize')]
+            plan.append({
+                'date': cdate.isoformat(),
+                'author': f'{author_name} <{author_email}>',
+                'downloads': [(c['id'], c['rid']) for c in changes],
+                'bytes': sum(known),
+                'unknown_size': len(changes) - len(known),
+                'committed': any(not c['gitignore'] for c in changes)
+            })
+
+        report = {
+            'commits': sum(p['committed'] for p in plan),
+            'downloads': sum(len(p['downloads']) for p in plan),
+            'bytes': sum(p['bytes'] for p in plan),
+            'unknown_size': sum(p['unknown_size'] for p in plan),
+            'plan': plan
+        }
+
+        if verbose:
+            for i, p in enumerate(plan):
+                print(f'Auto-commit {i+1}: {p["date"]}, {p["author"]}, {len(p["downloads"])} downloads, {p["bytes"] / 1024 / 1024:.2f}MB')
+            print(f'\nPlanned {report["commits"]} commits, {report["downloads"]} downloads, '
+                  f'{report["bytes"] / 1024 / 1024:.2f}MB (+{report["unknown_size"]} exports of unknown size).')
+
+        return report
+
+    def drop_unchanged(self, committed=None):
+        '''
+        Drops revisions whose md5Checksum matches the file's last committed
+        content, then bundles left empty. Returns the last checksum per file id.
+        '''
+        committed = dict(committed or {})
+        bundles = []
+        for cdate, author_name, author_email, changes in self.bundle:
+            kept = []
+            for c in changes:
+                md5 = c.md5Checksum
+                if md5 is not None and committed.get(c.id) == md5:
+                    continue
+                committed[c.id] = md5
+                kept.append(c)
+            if kept:
+                bundles.append((cdate, author_name, author_email, kept))
+
+        self.bundle = bundles
+
+        return committed
 
     def sanitize_filename(self, filename):
         RESERVED = {'CON','PRN','AUX','NUL'} | {f'COM{i}' for i in range(1,10)} | {f'LPT{i}' for i in range(1,10)}
@@ -333,12 +993,8 @@ class Drive2Git:
         if ext and ext.lower() in valid_exts:
             return filename 
 
-        export_map = {
-            'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',  # .docx
-            'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',     # .xlsx
-            'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',  # .pptx
-        }
-
+        # the extension of the format the drive exports to
+        export_map = getattr(self.drive, 'export_formats', export_formats.OFFICE_FORMATS)
         if mime_type in export_map:
             mime_type = export_map[mime_type]
 
@@ -385,6 +1041,10 @@ class Drive2Git:
         self.set_creation_time(filepath, change['createdTime'])
         self.set_modification_time(filepath, change['modifiedTime'])
 
+    def gitignore_lines(self):
+        files = self.ignore_folders + self.ignore_files
+        return [f'**/{l}\n' for l in files]
+
     def gitignore(self):
         file_path = os.path.join(self.local_path, self.name, '.gitignore')
         
@@ -393,16 +1053,135 @@ class Drive2Git:
             os.remove(file_path)
             
         # add new .gitignore file
-        files = self.ignore_folders + self.ignore_files
         with open(file_path, 'w') as f:
-            lines = [f'**/{l}\n' for l in files]
-            f.writelines(lines)
+            f.writelines(self.gitignore_lines())
+
+        # and the LFS attributes
+        if self.lfs is not None:
+            self.gitattributes()
+
+    def gitattributes_path(self):
+        return os.path.join(self.local_path, self.name, '.gitattributes')
+
+    def gitattributes(self):
+        with open(self.gitattributes_path(), 'w') as f:
+            f.writelines(self.lfs.attributes_lines(self.lfs_paths))
+        self.lfs_changed = False
+
+        return self.gitattributes_path()
+
+    def repo_path(self, change):
+        # repository-relative, with forward slashes
+        return os.path.relpath(change['path'], self.name).replace(os.sep, '/')
+
+    def plan_lfs(self, first_commit=True):
+        '''
+        Paths of the planned bundles that go to LFS, added to those of the
+        existing .gitattributes. A path goes to LFS for all its revisions once
+        one of them qualifies, so its attributes stay right for the history.
+        '''
+        if self.lfs is None:
+            return
+        known = set() if first_commit else self.lfs.read_attributes(self.gitattributes_path())
+        wanted = {self.repo_path(c) for _, _, _, changes in self.bundle for c in changes if not c['gitignore'] and self.lfs.wants(c)}
+        self.lfs_paths = known | wanted
+        self.lfs_changed = not wanted <= known
+
+    def lfs_pointer(self, chunks):
+        oid, size = self.lfs.store(chunks)
+        self.metrics.count('lfs.objects')
+        self.metrics.count('lfs.bytes', size)
+
+        return self.lfs.pointer(oid, size)
+
+    def add_to_index(self, repo, file_path, change):
+        path = self.repo_path(change)
+        if path not in self.lfs_paths:
+            repo.index.add([file_path])
+            return
+
+        # the content stays in the working tree, as git-lfs would leave it
+        with open(file_path, 'rb') as f:
+            pointer = self.lfs_pointer(iter(lambda: f.read(1024 ** 2), b''))
+        blob = repo.odb.store(IStream(git.Blob.type, len(pointer), io.BytesIO(pointer)))
+        repo.index.add([git.BaseIndexEntry((0o100644, blob.binsha, 0, path))])
+
+    def smudge_lfs(self):
+        # pointers checked out without git-lfs get their content back
+        if self.lfs is None:
+            return
+        for path in self.lfs.read_attributes(self.gitattributes_path()):
+            file_path = os.path.join(self.local_path, self.name, path)
+            if os.path.isfile(file_path):
+                self.lfs.smudge(file_path)
     
-    def make_repo(self, minutes=240, remove='git'):
-        # get commit info
-        self.bundle_commits(minutes)
-        self.max_versions()
-        
+    def make_repo(self, minutes=240, remove='git', prefetch=0, download_workers=4, max_inflight_bytes=256 * 1024 ** 2, backend='index', dry_run=False, metrics_path=None,
+                  resume=False, checkpoint=100):
+        '''
+        With `prefetch` > 0, the next `prefetch` bundles are downloaded by
+        `download_workers` threads (see DownloadPipeline) while commits are
+        written in order; the resulting history is the same as without. With
+        an async_drive, they are prefetched on asyncio (AsyncDownloadPipeline).
+
+        `backend` is 'index' (GitPython, through the working tree) or
+        'fast-import' (content streamed into `git fast-import`, then checked
+        out once at the end, without Drive timestamps).
+
+        With `dry_run`, nothing is downloaded or written: the plan_report of
+        planned commits, downloads and bytes is printed and returned.
+
+        Phase timings and counters are printed at the end, and written to
+        `metrics_path` if given (see write_metrics).
+
+        The crawl snapshot, plan and progress are journaled (see Journal) until
+        the run completes. With `resume`, an interrupted run continues from its
+        first unwritten bundle, without crawling again: create the Drive2Git
+        with crawl=False. The fast-import backend checkpoints every `checkpoint`
+        bundles, the index backend after each one.
+        '''
+        journal = Journal(self.journal_path(), every=checkpoint)
+        if resume and journal.exists():
+            repo, committed, first_commit, offset = self.resume_journal(journal)
+        else:
+            if not self.crawled:
+                self.crawl()
+
+            # get commit info
+            committed = self.plan_commits(minutes)
+            if dry_run:
+                return self.plan_report()
+
+            repo = self.start_repo(remove, journal, committed)
+            first_commit, offset = True, 0
+
+        # auto-commits
+        self.journal = journal
+        try:
+            self.run_commits(repo, prefetch, download_workers, max_inflight_bytes, first_commit=first_commit, offset=offset,
+                             backend=backend)
+        finally:
+            self.journal = None
+
+        # remember where the next sync_repo starts from
+        state = self.repo_state()
+        for file_id, md5 in committed.items():
+            if file_id in state['files']:
+                state['files'][file_id]['md5'] = md5
+        for file_id, last in self.last_revisions.items():
+            if file_id in state['files']:
+                state['files'][file_id].update(last)
+        state['startPageToken'] = self.page_token
+        state['lastCommitDate'] = self.last_commit_date()
+        self.save_state(state)
+        journal.clear()
+            
+        print(f'\nNew git folder written!')
+        self.write_metrics(metrics_path)
+
+    def start_repo(self, remove, journal, committed):
+        '''
+        A fresh repository with its folders, and a journal of the plan.
+        '''
         # remove any existing git folders
         if remove == 'git':
             remove_path = os.path.join(self.local_path, self.name, '.git')
@@ -418,26 +1197,195 @@ class Drive2Git:
 
         # create folders - move up???
         print('Creating folder structure.\n')
-        self.create_folders(self.folder_map)
+        if self.folder_map is not None:
+            self.create_folders(self.folder_map)
 
-        # auto-commits
-        first_commit = True
-        for i, (cdate, author_name, author_email, changes) in enumerate(self.bundle):
+        journal.start({
+            'folder_map': self.folder_map,
+            'spool': self.spool.path if self.spool is not None else None,
+            'page_token': self.page_token,
+            'committed': committed,
+            'last_revisions': self.last_revisions
+        }, self.bundle)
+
+        return repo
+
+    def journal_path(self):
+        return os.path.join(self.local_path, f'.{self.name}.journal')
+
+    def resume_journal(self, journal):
+        '''
+        Restores an interrupted make_repo from its journal, and its repository
+        to the last checkpoint. Returns (repo, committed, first_commit, offset).
+        '''
+        snapshot, self.bundle, progress = journal.load()
+        self.folder_map = snapshot['folder_map']
+        if self.folder_map is None and self.spool is None:
+            self.spool = RecordSpool(snapshot['spool'])
+        self.page_token = snapshot['page_token']
+        self.last_revisions = snapshot.get('last_revisions', {})
+        self.crawled = True
+
+        offset, head = progress['next'], progress['head']
+        print(f'Resuming at bundle {offset + 1} of {len(self.bundle)}.')
+        repo = git.Repo(os.path.join(self.local_path, self.name))
+        # commits written after the last checkpoint are written again
+        if head is not None:
+            repo.head.reset(head, index=True, working_tree=True)
+            self.smudge_lfs()
+        elif repo.head.is_valid():
+            repo.git.update_ref('-d', repo.head.ref.path)
+            repo.git.read_tree('--empty')
+        self.bundle = self.bundle[offset:]
+
+        return repo, snapshot['committed'], head is None, offset
+
+    def checkpoint(self, next_bundle, head):
+        if self.journal is not None:
+            self.journal.checkpoint(next_bundle, head)
+
+    def write_metrics(self, path=None):
+        # only this run's share, as the drive's metrics span runs; Prometheus textfile for a .prom path, JSON otherwise
+        self.run_metrics = self.metrics.since(self.run_mark)
+        self.run_mark = self.metrics.mark()
+        print(f'\n{self.run_metrics.report()}')
+        if path:
+            self.run_metrics.write(path)
+
+    def run_commits(self, repo, prefetch=0, download_workers=4, max_inflight_bytes=256 * 1024 ** 2, first_commit=True, offset=0, backend='index'):
+        pipeline = None
+        if prefetch > 0 and self.async_drive is not None:
+            pipeline = AsyncDownloadPipeline(self.async_drive, self.bundle, depth=prefetch, max_bytes=max_inflight_bytes)
+        elif prefetch > 0:
+            pipeline = DownloadPipeline(self.drive, self.bundle, depth=prefetch, workers=download_workers, max_bytes=max_inflight_bytes)
+        self.plan_lfs(first_commit)
+        try:
+            # downloads are timed apart, in the 'download' phase
+            with self.metrics.phase('commit'):
+                if backend == 'fast-import':
+                    self.commit_bundles_fast_import(repo, pipeline, first_commit=first_commit, offset=offset)
+                else:
+                    self.commit_bundles(repo, pipeline, first_commit=first_commit, offset=offset)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+
+    def commit_bundles_fast_import(self, repo, pipeline=None, first_commit=True, offset=0):
+        importer = FastImport(repo.working_tree_dir)
+        try:
+            for i, (cdate, author_name, author_email, changes) in enumerate(self.bundle, offset):
+                print(f'Auto-commit {i+1}, adding {len(changes)} bundled changes...')
+                if pipeline is None:
+                    self.drive.prefetch_links_v2(changes)
+                    downloads = [None] * len(changes)
+                else:
+                    downloads = pipeline.get(i - offset)
+                pushed_files = []
+                for change, download in zip(changes, downloads):
+                    print(f'\t{change["path"]}, v{change["version"]}')
+                    try:
+                        # ignored files only go to the working tree
+                        if change['gitignore']:
+                            file_path = os.path.join(self.local_path, change['path'])
+                            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                            with self.metrics.phase('download'):
+                                if download is None:
+                                    self.drive.stream_file_v2(change, out=file_path)
+                                else:
+                                    pipeline.write(download, file_path)
+                            print(f'\t\tNot added to commit.')
+                            continue
+
+                        with self.metrics.phase('download'):
+                            if download is None:
+                                size, chunks = self.drive.iter_file_v2(change)
+                            else:
+                                size, chunks = pipeline.iter_file(download)
+                    except Exception as exception:
+                        print(f'\t\tFile {str(change)} - error :{str(exception)}')
+                        continue
+
+                    # content is pulled from the stream while writing the blob
+                    with self.metrics.phase('download'):
+                        path = self.repo_path(change)
+                        if path in self.lfs_paths:
+                            pointer = self.lfs_pointer(chunks)
+                            pushed_files.append((path, importer.blob([pointer], len(pointer))))
+                            continue
+
+                        if size is None:
+                            # no usable length, spool to learn it
+                            spool = tempfile.SpooledTemporaryFile(max_size=64 * 1024 ** 2)
+                            for chunk in chunks:
+                                spool.write(chunk)
+                            size = spool.tell()
+                            spool.seek(0)
+                            chunks = iter(lambda: spool.read(32768), b'')
+
+                        pushed_files.append((path, importer.blob(chunks, size)))
+
+                if pushed_files:
+                    # add commit comments
+                    if not first_commit:
+                        comments = f'Auto-commit {i+1} (via Google Drive-to-git tool).'
+                    else:
+                        # add gitignore
+                        lines = ''.join(self.gitignore_lines()).encode()
+                        pushed_files.append(('.gitignore', importer.blob([lines], len(lines))))
+                        comments = 'Initial auto-commit (via Google Drive-to-git tool).'
+                    if self.lfs is not None and (first_commit or self.lfs_changed):
+                        lines = ''.join(self.lfs.attributes_lines(self.lfs_paths)).encode()
+                        pushed_files.append(('.gitattributes', importer.blob([lines], len(lines))))
+                        self.lfs_changed = False
+
+                    first_commit = False
+                    importer.commit(comments, author_name, author_email, cdate, pushed_files)
+                    self.metrics.count('commits')
+
+                if self.journal is not None and (i + 1 - offset) % self.journal.every == 0:
+                    # make the commits so far durable, then carry on from them
+                    importer.close()
+                    self.checkpoint(i + 1, repo.git.rev_parse('HEAD') if not first_commit else None)
+                    importer = FastImport(repo.working_tree_dir)
+        except BaseException:
+            importer.abort()
+            raise
+
+        importer.close()
+
+        # fill the working tree once, from the last commit
+        if repo.head.is_valid():
+            repo.head.reset(index=True, working_tree=True)
+            self.smudge_lfs()
+
+    def commit_bundles(self, repo, pipeline=None, first_commit=True, offset=0):
+        head = repo.head.commit.hexsha if repo.head.is_valid() else None
+        for i, (cdate, author_name, author_email, changes) in enumerate(self.bundle, offset):
             gitAuthor = git.Actor(name=author_name, email=author_email)
             # make files
             print(f'Auto-commit {i+1}, adding {len(changes)} bundled changes...')
+            if pipeline is None:
+                self.drive.prefetch_links_v2(changes)
+                downloads = [None] * len(changes)
+            else:
+                downloads = pipeline.get(i - offset)
             pushed_files = []
-            for change in changes:
+            for change, download in zip(changes, downloads):
                 file_path = os.path.join(self.local_path, change['path'])
                 print(f'\t{change["path"]}, v{change["version"]}')
                 try:
-                    self.drive.stream_file_v2(change, out=file_path)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    with self.metrics.phase('download'):
+                        if download is None:
+                            self.drive.stream_file_v2(change, out=file_path)
+                        else:
+                            pipeline.write(download, file_path)
                     # add file
                     if not change['gitignore']:
                         self.apply_drive_timestamps(file_path, change)
 
-                        repo.index.add([file_path])
-                        pushed_files.append(pushed_files)
+                        self.add_to_index(repo, file_path, change)
+                        pushed_files.append(file_path)
                     else:
                         print(f'\t\tNot added to commit.')
                 except Exception as exception:
@@ -453,11 +1401,226 @@ class Drive2Git:
                     gitignore_path = os.path.join(self.local_path, self.name, '.gitignore')
                     pushed_files.append(gitignore_path)
                     repo.index.add([gitignore_path])
+                    if self.lfs is not None:
+                        repo.index.add([self.gitattributes_path()])
                     comments = 'Initial auto-commit (via Google Drive-to-git tool).'
+                if self.lfs_changed:
+                    # LFS paths new since the first commit
+                    repo.index.add([self.gitattributes()])
                 
                 first_commit = False
-                repo.index.commit(comments,
+                head = repo.index.commit(comments,
+                                         author=gitAuthor, committer=gitAuthor,
+                                         author_date=cdate, commit_date=cdate).hexsha
+                self.metrics.count('commits')
+
+            self.checkpoint(i + 1, head)
+
+    def state_path(self):
+        return os.path.join(self.local_path, self.name, '.git', 'drive2git.json')
+
+    def load_state(self):
+        if not os.path.exists(self.state_path()):
+            return None
+        with open(self.state_path()) as f:
+            return json.load(f)
+
+    def save_state(self, state):
+        with open(self.state_path(), 'w') as f:
+            json.dump(state, f)
+
+    def repo_state(self, folder_map=None, parent=None, state=None):
+        '''
+        Recursive. Folder and file paths by id, used by sync_repo to place changes.
+        '''
+        if state is None:
+            state = {'folders': {}, 'files': {}}
+
+        if folder_map is None and self.spool is not None:
+            for folder, parent in self.spool.items('folder'):
+                state['folders'][folder['id']] = {'path': folder['path'], 'title': folder['name'], 'parent': parent}
+            for content, parent in self.spool.items('file'):
+                state['files'][content['id']] = {'path': content['path'], 'parent': parent}
+            return state
+
+        folder_map = folder_map or self.folder_map
+
+        state['folders'][folder_map['id']] = {'path': folder_map['path'], 'title': folder_map['name'], 'parent': parent}
+        for content in folder_map['contents']:
+            if 'contents' in content.keys():
+                self.repo_state(content, parent=folder_map['id'], state=state)
+            else:
+                state['files'][content['id']] = {'path': content['path'], 'parent': folder_map['id']}
+
+        return state
+
+    def last_commit_date(self, default=''):
+        return max([default] + [last['modified'] for last in self.last_revisions.values()])
+
+    def folder_path(self, folder_id, folders, seen):
+        '''
+        Recursive. Path of a folder in the synced tree, None when it is outside
+        of it or ignored; newly found folders are added to `folders`.
+        '''
+        if folder_id in folders:
+            return folders[folder_id]['path']
+        if folder_id in seen:
+            return seen[folder_id]
+        seen[folder_id] = None
+
+        try:
+            folder = self.drive.id_get(folder_id)
+        except Exception:
+            return None
+
+        name = self.ensure_filepath(folder['title'], folder['mimeType'])
+        if folder.get('labels', {}).get('trashed') or self.check_ignore(name, self.ignore_folders):
+            return None
+
+        for p in folder.get('parents', []):
+            parent_path = self.folder_path(p['id'], folders, seen)
+            if parent_path is not None:
+                path = os.path.join(parent_path, name)
+                folders[folder_id] = {'path': path, 'title': folder['title'], 'parent': p['id']}
+                seen[folder_id] = path
+                return path
+
+        return None
+
+    def sync_repo(self, minutes=240, prefetch=0, download_workers=4, max_inflight_bytes=256 * 1024 ** 2, metrics_path=None):
+        '''
+        Appends commits for what changed on Drive since the last make_repo or
+        sync_repo, using the Drive changes feed instead of a crawl. Deleted and
+        moved files are removed in one extra commit. Renamed or moved folders
+        make a full make_repo. Files moved out of the tree are kept, since they
+        can't be told apart from shortcut targets.
+        '''
+        state = self.load_state()
+        if state is None:
+            print('No sync state found, making full repo.')
+            return self.make_repo(minutes, prefetch=prefetch, download_workers=download_workers, max_inflight_bytes=max_inflight_bytes,
+                                  metrics_path=metrics_path)
+
+        repo = git.Repo(os.path.join(self.local_path, self.name))
+        folders = state['folders']
+        files = state['files']
+        since = state['lastCommitDate']  # for files synced before per-file dates were kept
+        self.last_revisions = {}
+
+        print('Listing Drive changes.')
+        with self.metrics.phase('changes'):
+            changes, page_token = self.drive.list_changes_v2(state['startPageToken'])
+
+        # keep the latest change per item
+        latest = {}
+        for change in changes:
+            latest[change['fileId']] = change
+
+        removed = []
+        removed_dates = []
+        entries = []
+        seen = {}
+        for file_id, change in latest.items():
+            f = change.get('file')
+            gone = change.get('deleted') or f is None or f.get('labels', {}).get('trashed')
+
+            if file_id in folders:
+                if gone:
+                    path = folders.pop(file_id)['path']
+                    removed.append(path)
+                    removed_dates.append(change.get('modificationDate'))
+                    for i in [i for i, v in files.items() if v['path'].startswith(path + os.sep)]:
+                        files.pop(i)
+                elif folders[file_id]['parent'] is not None:
+                    parents = [p['id'] for p in f.get('parents', [])]
+                    if f['title'] != folders[file_id]['title'] or folders[file_id]['parent'] not in parents:
+                        print(f'Folder {f["title"]} renamed or moved, making full repo.')
+                        self.crawl()
+                        return self.make_repo(minutes, prefetch=prefetch, download_workers=download_workers, max_inflight_bytes=max_inflight_bytes,
+                                              metrics_path=metrics_path)
+                continue
+
+            if gone:
+                if file_id in files:
+                    removed.append(files.pop(file_id)['path'])
+                    removed_dates.append(change.get('modificationDate'))
+                continue
+
+            # new folders are added once files are found in them; shortcut targets are tracked by id
+            if f['mimeType'] in ['application/vnd.google-apps.folder', 'application/vnd.google-apps.shortcut']:
+                continue
+
+            parent, parent_path = None, None
+            for p in f.get('parents', []):
+                parent_path = self.folder_path(p['id'], folders, seen)
+                if parent_path is not None:
+                    parent = p['id']
+                    break
+
+            if parent is None:
+                if file_id not in files:
+                    continue
+                # shortcut target or moved out of the tree, stays where it is
+                parent = files[file_id]['parent']
+                parent_path = folders[parent]['path']
+
+            entry = self.file_entry(folders[parent], f, parent_path)
+            entry['moved'] = file_id in files and files[file_id]['path'] != entry['path']
+            if entry['moved']:
+                removed.append(files[file_id]['path'])
+                removed_dates.append(change.get('modificationDate'))
+            # the file's own last synced revision date; a file new to the tree has none
+            last = files[file_id].get('modified', since) if file_id in files else ''
+            files[file_id] = {**files.get(file_id, {}), 'path': entry['path'], 'parent': parent}
+            if entry['moved']:
+                files[file_id]['md5'] = None
+            entry['last'] = last
+            entries.append(entry)
+
+        # only revisions newer than each file's last synced one, or the latest one of moved files
+        self.fill_revisions_v2(entries)
+        contents = []
+        for entry in entries:
+            revisions = entry['revisions']
+            last = entry.pop('last')
+            if revisions:
+                newer = [r for r in revisions if (r.get('modifiedDate') or entry['modifiedTime']) > last]
+                entry['revisions'] = newer or (revisions[-1:] if entry['moved'] else [])
+                if entry['revisions']:
+                    contents.append(entry)
+            elif entry['modifiedTime'] > last or entry['moved']:
+                contents.append(entry)
+
+        offset = int(repo.git.rev_list('--count', 'HEAD'))
+
+        # deleted and moved files
+        if removed:
+            print(f'Removing {len(removed)} deleted or moved items.')
+            repo.git.rm('-r', '-q', '--ignore-unmatch', '--', *[os.path.join(self.local_path, p) for p in removed])
+            if repo.index.diff('HEAD'):
+                utc = self.config['utc']
+                rdate = max(d for d in removed_dates if d) if any(removed_dates) else datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                cdate = utc.localize(datetime.datetime.strptime(rdate, '%Y-%m-%dT%H:%M:%S.%fZ')).astimezone(self.config['tz'])
+                gitAuthor = self.config['author']
+                offset += 1
+                repo.index.commit(f'Auto-commit {offset} (via Google Drive-to-git tool).',
                                   author=gitAuthor, committer=gitAuthor,
                                   author_date=cdate, commit_date=cdate)
-            
-        print(f'\nNew git folder written!')
\ No newline at end of file
+
+        # new revisions on top of the existing history
+        self.bundle = []
+        if contents:
+            committed = self.plan_commits(minutes, folder_map={'path': self.name, 'contents': contents},
+                                          committed={i: v.get('md5') for i, v in files.items()})
+            for file_id, md5 in committed.items():
+                files[file_id]['md5'] = md5
+            for file_id, last in self.last_revisions.items():
+                files[file_id].update(last)
+            self.run_commits(repo, prefetch, download_workers, max_inflight_bytes, first_commit=False, offset=offset)
+
+        state['startPageToken'] = page_token
+        state['lastCommitDate'] = self.last_commit_date(default=since)
+        self.save_state(state)
+
+        print(f'\nSynced {len(self.bundle)} new commits and {len(removed)} removals.')
+        self.write_metrics(metrics_path)
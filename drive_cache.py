@@ -0,0 +1,213 @@
+# local imports
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import time
+
+# On-disk cache of Drive metadata
+class MetadataCache:
+    '''
+    Folder listings and revision lists kept between runs in SQLite.
+
+    Revision lists are keyed by file id and the file's modifiedDate, so they
+    stay valid until the file changes. A folder's modifiedDate does not follow
+    its children, so listings are only reused for `listing_ttl` seconds
+    (0: never). Entries unused for `max_age` seconds, and the least recently
+    used ones past `max_bytes` of stored data, are evicted when the cache opens.
+    '''
+    def __init__(self, path='drive_cache.sqlite', listing_ttl=0, max_age=None, max_bytes=None):
+        self.path = path
+        self.listing_ttl = listing_ttl
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS revisions (id TEXT PRIMARY KEY, modified TEXT, data TEXT, accessed REAL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS listings (id TEXT PRIMARY KEY, data TEXT, fetched REAL, accessed REAL)')
+        self.db.commit()
+        self.evict()
+
+    def get_revisions(self, file_id, modified):
+        with self.lock:
+            row = self.db.execute('SELECT data FROM revisions WHERE id = ? AND modified = ?', (file_id, modified)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE revisions SET accessed = ? WHERE id = ?', (time.time(), file_id))
+            self.db.commit()
+
+        return json.loads(row[0])
+
+    def put_revisions(self, file_id, modified, revisions):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO revisions VALUES (?, ?, ?, ?)', (file_id, modified, json.dumps(revisions), time.time()))
+            self.db.commit()
+
+    def get_listing(self, folder_id):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT data FROM listings WHERE id = ? AND fetched > ?', (folder_id, now - self.listing_ttl)).fetchone()
+            if row is None:
+                return None
+            self.db.execute('UPDATE listings SET accessed = ? WHERE id = ?', (now, folder_id))
+            self.db.commit()
+
+        return json.loads(row[0])
+
+    def put_listing(self, folder_id, contents):
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)', (folder_id, json.dumps(contents), now, now))
+            self.db.commit()
+
+    def invalidate(self, ids=None):
+        '''
+        Drops the entries of the given file/folder ids, or everything.
+        '''
+        with self.lock:
+            for table in ['revisions', 'listings']:
+                if ids is None:
+                    self.db.execute(f'DELETE FROM {table}')
+                else:
+                    self.db.executemany(f'DELETE FROM {table} WHERE id = ?', [(i,) for i in ids])
+            self.db.commit()
+
+    def evict(self, max_age=None, max_bytes=None):
+        max_age = max_age if max_age is not None else self.max_age
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+
+        with self.lock:
+            if max_age is not None:
+                for table in ['revisions', 'listings']:
+                    self.db.execute(f'DELETE FROM {table} WHERE accessed < ?', (time.time() - max_age,))
+
+            if max_bytes is not None:
+                rows = self.db.execute("SELECT id, length(data), accessed, 'revisions' FROM revisions "
+                                       "UNION ALL SELECT id, length(data), accessed, 'listings' FROM listings "
+                                       "ORDER BY accessed DESC").fetchall()
+                total = 0
+                for i, size, accessed, table in rows:
+                    total += size
+                    if total > max_bytes:
+                        self.db.execute(f'DELETE FROM {table} WHERE id = ?', (i,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+# On-disk store of downloaded revisions
+class BlobCache:
+    '''
+    Revision content stored under `root` by its md5, found by (file id,
+    revision id) or by Drive's md5Checksum. Only revisions are stored, since
+    they never change; the least recently used blobs past `max_bytes` are evicted.
+    '''
+    def __init__(self, root='blob_cache', max_bytes=10 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'tmp'), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(root, 'index.sqlite'), timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS keys (id TEXT, rid TEXT, md5 TEXT, PRIMARY KEY (id, rid))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs (md5 TEXT PRIMARY KEY, size INTEGER, accessed REAL)')
+        self.db.commit()
+        # bytes stored, kept up to date by add() so blobs are only scanned for eviction past max_bytes
+        self.total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM blobs').fetchone()[0]
+
+    def blob_path(self, md5):
+        return os.path.join(self.root, 'objects', md5[:2], md5[2:])
+
+    def lookup(self, file_id, rid, md5=None):
+        '''
+        Path of the cached content, None on a miss.
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT md5 FROM keys WHERE id = ? AND rid = ?', (file_id, rid)).fetchone()
+            found = row[0] if row else md5
+            if found is None or not os.path.exists(self.blob_path(found)):
+                return None
+            if self.db.execute('SELECT 1 FROM blobs WHERE md5 = ?', (found,)).fetchone() is None:
+                return None
+            self.db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?)', (file_id, rid, found))
+            self.db.execute('UPDATE blobs SET accessed = ? WHERE md5 = ?', (time.time(), found))
+            self.db.commit()
+
+        return self.blob_path(found)
+
+    def writer(self, file_id, rid):
+        return BlobWriter(self, file_id, rid)
+
+    def add(self, file_id, rid, tmp_path, md5, size):
+        path = self.blob_path(md5)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        with self.lock:
+            row = self.db.execute('SELECT size FROM blobs WHERE md5 = ?', (md5,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)', (md5, size, time.time()))
+            self.db.execute('INSERT OR REPLACE INTO keys VALUES (?, ?, ?)', (file_id, rid, md5))
+            self.db.commit()
+            self.total += size - (row[0] if row else 0)
+        if self.total > self.max_bytes:
+            self.evict()
+
+        return path
+
+    def evict(self, max_bytes=None):
+        max_bytes = max_bytes if max_bytes is not None else self.max_bytes
+        with self.lock:
+            total = 0
+            kept = 0
+            rows = self.db.execute('SELECT md5, size FROM blobs ORDER BY accessed DESC').fetchall()
+            for n, (md5, size) in enumerate(rows):
+                total += size
+                # the newest blob stays, even if larger than the cap
+                if total > max_bytes and n > 0:
+                    self.db.execute('DELETE FROM blobs WHERE md5 = ?', (md5,))
+                    self.db.execute('DELETE FROM keys WHERE md5 = ?', (md5,))
+                    if os.path.exists(self.blob_path(md5)):
+                        os.remove(self.blob_path(md5))
+                else:
+                    kept += size
+            self.db.commit()
+            # recounted from the table, which other processes may share
+            self.total = kept
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class BlobWriter:
+    '''
+    Streams one download into the cache, hashing it on the way. The blob is
+    only added if the `with` block finishes without error.
+    '''
+    def __init__(self, cache, file_id, rid):
+        self.cache = cache
+        self.file_id = file_id
+        self.rid = rid
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.path = None
+
+    def __enter__(self):
+        fd, self.tmp_path = tempfile.mkstemp(dir=os.path.join(self.cache.root, 'tmp'))
+        self.file = os.fdopen(fd, 'wb')
+        return self
+
+    def write(self, chunk):
+        self.md5.update(chunk)
+        self.size += len(chunk)
+        self.file.write(chunk)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is None:
+            self.path = self.cache.add(self.file_id, self.rid, self.tmp_path, self.md5.hexdigest(), self.size)
+        else:
+            os.remove(self.tmp_path)
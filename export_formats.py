@@ -0,0 +1,109 @@
+# local imports
+import io
+import re
+import zipfile
+
+# Export format of each Google format, Office files by default
+OFFICE_FORMATS = {
+    'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',  # .docx
+    'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',     # .xlsx
+    'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',  # .pptx
+    'application/vnd.google-apps.drawing': 'image/png',
+}
+
+# Text formats git can diff and delta (sheets export their first sheet only)
+TEXT_FORMATS = {
+    'application/vnd.google-apps.document': 'text/markdown',
+    'application/vnd.google-apps.spreadsheet': 'text/csv',
+    'application/vnd.google-apps.presentation': 'text/plain',
+    'application/vnd.google-apps.drawing': 'image/svg+xml',
+}
+
+# Exports that are zip containers
+ZIP_FORMATS = {
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.presentationml.presentation',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.presentation',
+    'application/epub+zip',
+    'application/zip',
+}
+
+# Entry metadata rewritten on each export
+VOLATILE = {
+    'docProps/core.xml': re.compile(rb'(<dcterms:modified[^>]*>)[^<]*(</dcterms:modified>)'),
+    'meta.xml': re.compile(rb'(<dc:date>)[^<]*(</dc:date>)'),
+}
+
+def normalize_zip(data):
+    '''
+    The same archive with fixed entry timestamps and attributes, entries
+    stored rather than compressed, and export dates cleared, so the same
+    revision always exports to the same bytes and git can delta revisions
+    against each other. Entry order is kept (ODF needs its mimetype first).
+    '''
+    source = zipfile.ZipFile(io.BytesIO(data))
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as target:
+        for info in source.infolist():
+            content = source.read(info)
+            if info.filename in VOLATILE:
+                content = VOLATILE[info.filename].sub(rb'\1\2', content)
+            entry = zipfile.ZipInfo(info.filename, date_time=(1980, 1, 1, 0, 0, 0))
+            entry.create_system = 3
+            entry.external_attr = (0o40755 if info.is_dir() else 0o100644) << 16
+            target.writestr(entry, content)
+
+    return out.getvalue()
+
+# Export choices of a Drive client
+class DriveExports:
+    '''
+    What GoogleDrive and AsyncGoogleDrive derive alike from their
+    `export_formats` (Google format -> export MIME type) and
+    `normalize_exports`: download links, blob cache keys and whether a
+    download is normalized.
+    '''
+    def has_links(self, f):
+        # links prefetched or listed, else one request for them
+        return bool(f.get('exportLinks') or f.get('downloadUrl'))
+
+    def keep_links(self, f, links):
+        # links looked up for `f`, kept on it for its next downloads
+        f['exportLinks'] = links.get('exportLinks')
+        f['downloadUrl'] = links.get('downloadUrl')
+
+    def stale_link(self, error):
+        # links are short-lived, and listed, cached or journaled ones may have expired: Drive turns those down with a 401, 403 or 404
+        status, _ = self.scheduler.status(error)
+        return status in (401, 403, 404) and not self.scheduler.rate_limited(error)
+
+    def link_v2(self, f, links):
+        '''
+        Download or export URL of file entry `f`, from its `links` (the entry
+        itself, or its file or revision resource).
+        '''
+        format = self.export_formats.get(f['type'])
+        if format:
+            url = (links.get('exportLinks') or {}).get(format)
+            if url and f['rid']:
+                url += f'&revision={f["rid"]}'
+        else:
+            url = links.get('downloadUrl')
+        if not url:
+            # e.g. no export to `format`, or no content at all (forms, sites): retrying can't help
+            raise ValueError(f'No download link for {f["id"]} ({f["type"]}{" as " + format if format else ""}).')
+
+        return url
+
+    def cache_rid(self, f):
+        # exports are cached per format, so changing formats doesn't serve stale blobs
+        format = self.export_formats.get(f['type'])
+        if format is None:
+            return f['rid']
+        return f'{f["rid"]}:{format}' + (':normalized' if self.normalize_exports else '')
+
+    def normalizes(self, f):
+        return self.normalize_exports and self.export_formats.get(f['type']) in ZIP_FORMATS
@@ -0,0 +1,541 @@
+# local imports
+import io
+import re
+import json
+import time
+import asyncio
+import random
+import hashlib
+import datetime
+import zipfile
+import threading
+import collections
+import urllib.parse
+import httplib2
+import requests
+
+# Google API imports
+from googleapiclient.errors import HttpError
+
+FOLDER = 'application/vnd.google-apps.folder'
+SHORTCUT = 'application/vnd.google-apps.shortcut'
+# export formats (MIME type: exportFormat) of each Google format
+EXPORTS = {
+    'application/vnd.google-apps.document': {
+        'application/vnd.openxmlformats-officedocument.wordprocessingml.document': 'docx',
+        'text/markdown': 'md',
+        'text/plain': 'txt',
+    },
+    'application/vnd.google-apps.spreadsheet': {
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+        'text/csv': 'csv',
+    },
+    'application/vnd.google-apps.presentation': {
+        'application/vnd.openxmlformats-officedocument.presentationml.presentation': 'pptx',
+        'text/plain': 'txt',
+    },
+}
+ZIP_EXPORTS = {'docx', 'xlsx', 'pptx'}
+
+# Offline stand-in for the Drive v2 API
+class FakeDrive:
+    '''
+    In-memory Drive v2 service with a synthetic tree: `folders` folders,
+    about `files` files each, up to `revisions` revisions per file, a share
+    `docs` of Google documents (export links only) and `shortcuts` shortcuts
+    to files. Use it as the `service` of a GoogleDrive (see google_drive())
+    and its `session` for downloads.
+
+    Every round-trip sleeps `latency` seconds and fails with a 429 or 5xx
+    with probability `error_rate`. Calls are counted in `calls`, downloaded
+    bytes in `bytes_served`. async_google_drive() gives an AsyncGoogleDrive
+    on the same data, whose latency is awaited. Office exports are zips which, with
+    `volatile_exports`, like Drive's carry the export time, so each export
+    of a revision differs. Download and export links are short-lived, as
+    Drive's: after expire_links(), the ones handed out so far fail with a 403.
+    '''
+    BASE_URL = 'https://fake-drive.invalid'
+
+    def __init__(self, folders=20, files=5, revisions=3, docs=0.2, shortcuts=5, file_size=4096, latency=0.0, error_rate=0.0, seed=0,
+                 volatile_exports=False):
+        self.latency = latency
+        self.volatile_exports = volatile_exports
+        self.error_rate = error_rate
+        self.rnd = random.Random(seed)
+        self.faults = random.Random(seed + 1)  # separate, so errors don't change the data
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.bytes_served = 0
+        self.exports = 0
+        self.link_key = 0  # in the links handed out, bumped by expire_links()
+        self.items = {}
+        self.history = {}  # file id: revisions
+        self.sizes = {}  # (file id, revision id): content size
+        self.change_log = []
+        self.next_id = 0
+        self.clock = datetime.datetime(2020, 1, 1)
+        self.session = FakeSession(self)
+        self.creds = FakeCredentials()
+
+        self.root_id = self.add_folder('fake_drive', None)
+        parents = [self.root_id]
+        for n in range(folders):
+            parents.append(self.add_folder(f'dir{n}', self.rnd.choice(parents)))
+        targets = []
+        for n in range(folders * files):
+            mime = self.rnd.choice(list(EXPORTS)) if self.rnd.random() < docs else 'text/plain'
+            size = self.rnd.randint(file_size // 2, file_size * 3 // 2)
+            targets.append(self.add_file(f'file{n}.txt' if mime == 'text/plain' else f'doc{n}', self.rnd.choice(parents),
+                                         mime, self.rnd.randint(1, revisions), size))
+        for n in range(min(shortcuts, len(targets))):
+            self.add_shortcut(f'shortcut{n}', self.rnd.choice(parents), self.rnd.choice(targets))
+
+        # the tree above is the starting state, not changes
+        self.change_log = []
+
+    def google_drive(self, **kwargs):
+        '''
+        A GoogleDrive talking to this fake, without OAuth.
+        '''
+        from google_drive import GoogleDrive
+        return GoogleDrive(service=self, session=self.session, creds=self.creds, **kwargs)
+
+    def async_google_drive(self, drive=None, **kwargs):
+        '''
+        An AsyncGoogleDrive talking to this fake, sharing `drive`'s quota,
+        metrics and caches if given.
+        '''
+        from async_google_drive import AsyncGoogleDrive
+        return AsyncGoogleDrive.from_drive(drive or self.google_drive(), session=FakeAsyncSession(self), **kwargs)
+
+    # synthetic data
+
+    def new_id(self, prefix):
+        self.next_id += 1
+        return f'{prefix}{self.next_id}'
+
+    def tick(self):
+        # one to ten hours between generated events
+        self.clock += datetime.timedelta(minutes=self.rnd.randint(60, 600))
+        return self.clock.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def author(self):
+        n = self.rnd.randrange(5)
+        return {'displayName': f'Author {n}', 'emailAddress': f'author{n}@example.com'}
+
+    def add_folder(self, title, parent):
+        date = self.tick()
+        i = self.new_id('folder')
+        self.items[i] = {
+            'id': i, 'title': title, 'mimeType': FOLDER, 'createdDate': date, 'modifiedDate': date,
+            'parents': [{'id': parent}] if parent else [], 'labels': {'trashed': False}
+        }
+        self.record_change(i)
+        return i
+
+    def add_file(self, title, parent, mime='text/plain', revisions=1, size=4096):
+        date = self.tick()
+        i = self.new_id('file')
+        self.items[i] = {
+            'id': i, 'title': title, 'mimeType': mime, 'createdDate': date, 'modifiedDate': date,
+            'parents': [{'id': parent}], 'labels': {'trashed': False}
+        }
+        self.history[i] = []
+        for n in range(revisions):
+            self.add_revision(i, size, date=date if n == 0 else None)
+        return i
+
+    def add_shortcut(self, title, parent, target):
+        date = self.tick()
+        i = self.new_id('shortcut')
+        self.items[i] = {
+            'id': i, 'title': title, 'mimeType': SHORTCUT, 'createdDate': date, 'modifiedDate': date,
+            'parents': [{'id': parent}], 'labels': {'trashed': False}, 'shortcutDetails': {'targetId': target}
+        }
+        self.record_change(i)
+        return i
+
+    def add_revision(self, file_id, size=None, date=None):
+        '''
+        New head revision of a file, as an edit made now.
+        '''
+        item = self.items[file_id]
+        revisions = self.history[file_id]
+        rid = f'{file_id}r{len(revisions)}'
+        size = size or (self.sizes[file_id, revisions[-1]['id']] if revisions else 4096)
+        self.sizes[file_id, rid] = size
+        revision = {'id': rid, 'modifiedDate': date or self.tick(), 'lastModifyingUser': self.author()}
+        if item['mimeType'] in EXPORTS:
+            # Google formats have no size or checksum, only export links
+            revision['exportLinks'] = self.export_links(file_id)
+        else:
+            revision['downloadUrl'] = f'{self.BASE_URL}/download/{file_id}?revision={rid}&alt=media'
+            revision['md5Checksum'] = hashlib.md5(self.content(file_id, rid, size)).hexdigest()
+            revision['fileSize'] = str(size)
+        revisions.append(revision)
+
+        # the file itself shows its head revision
+        item.update({k: v for k, v in revision.items() if k != 'id'})
+        item['lastModifyingUserName'] = revision['lastModifyingUser']['displayName']
+        if item['mimeType'] in EXPORTS:
+            item['exportLinks'] = self.export_links(file_id)
+        else:
+            item['downloadUrl'] = f'{self.BASE_URL}/download/{file_id}?alt=media'
+        self.record_change(file_id)
+        return rid
+
+    def export_links(self, file_id):
+        # like Drive, a revision is exported with the file's links plus &revision=
+        formats = EXPORTS[self.items[file_id]['mimeType']]
+        return {mime: f'{self.BASE_URL}/export/{file_id}?exportFormat={ext}' for mime, ext in formats.items()}
+
+    def content(self, file_id, rid, size):
+        block = f'{file_id} {rid}\n'.encode()
+        return (block * (size // len(block) + 1))[:size]
+
+    def export(self, file_id, rid, size, format):
+        data = self.content(file_id, rid, size)
+        if format not in ZIP_EXPORTS:
+            return data
+
+        # a minimal Office document, stamped with the export time if volatile
+        with self.lock:
+            self.exports += 1
+            stamp = self.exports if self.volatile_exports else 0
+        date_time = (2020, 1, 1 + stamp % 28, 0, 0, 2 * (stamp % 30))
+        modified = f'2020-01-01T00:00:{stamp % 60:02}Z'.encode()
+        out = io.BytesIO()
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as document:
+            document.writestr(zipfile.ZipInfo('[Content_Types].xml', date_time), b'<Types/>')
+            document.writestr(zipfile.ZipInfo('docProps/core.xml', date_time),
+                              b'<cp:coreProperties><dcterms:modified>' + modified + b'</dcterms:modified></cp:coreProperties>')
+            document.writestr(zipfile.ZipInfo('content.bin', date_time), data)
+
+        return out.getvalue()
+
+    def signed(self, item):
+        # a copy of a file or revision, with links valid until expire_links()
+        item = dict(item)
+        if 'downloadUrl' in item:
+            item['downloadUrl'] += f'&key={self.link_key}'
+        if 'exportLinks' in item:
+            item['exportLinks'] = {mime: f'{url}&key={self.link_key}' for mime, url in item['exportLinks'].items()}
+        return item
+
+    def expire_links(self):
+        self.link_key += 1
+
+    def record_change(self, file_id, deleted=False):
+        item = self.items.get(file_id)
+        self.change_log.append({
+            'id': str(len(self.change_log) + 1), 'fileId': file_id, 'deleted': deleted,
+            'modificationDate': item['modifiedDate'] if item else self.tick(),
+            'file': None if deleted else self.signed(item)
+        })
+
+    def modify(self, file_id):
+        return self.add_revision(file_id)
+
+    def trash(self, file_id):
+        self.items[file_id]['labels'] = {'trashed': True}
+        self.record_change(file_id)
+
+    def delete(self, file_id):
+        del self.items[file_id]
+        self.history.pop(file_id, None)
+        self.record_change(file_id, deleted=True)
+
+    def move(self, file_id, parent, title=None):
+        item = self.items[file_id]
+        item['parents'] = [{'id': parent}]
+        if title:
+            item['title'] = title
+        self.record_change(file_id)
+
+    # simulated network
+
+    def fault(self):
+        # status of an injected failure, or None
+        with self.lock:
+            self.calls['requests'] += 1
+            failed = self.faults.random() < self.error_rate
+            status = self.faults.choice([429, 500, 503])
+        return status if failed else None
+
+    def round_trip(self, name):
+        status = self.fault()
+        if self.latency:
+            time.sleep(self.latency)
+        if status is not None:
+            raise self.http_error(status, name)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def http_error(self, status, uri=''):
+        reason = 'rateLimitExceeded' if status == 429 else 'backendError'
+        content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode()
+        return HttpError(httplib2.Response({'status': status}), content, uri=uri)
+
+    # Drive v2 resources, as built by googleapiclient
+
+    def files(self):
+        return FakeResource(self, 'files')
+
+    def revisions(self):
+        return FakeResource(self, 'revisions')
+
+    def changes(self):
+        return FakeResource(self, 'changes')
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def files_get(self, fileId, **kwargs):
+        item = self.items.get(fileId)
+        if item is None:
+            raise self.http_error(404, f'files/{fileId}')
+        return self.signed(item)
+
+    def files_list(self, q='', maxResults=100, pageToken=None, **kwargs):
+        parent = re.search(r'"([^"]+)" in parents', q)
+        trashed = 'trashed = false' not in q
+        items = [self.signed(i) for i in self.items.values()
+                 if (parent is None or {'id': parent.group(1)} in i['parents']) and (trashed or not i['labels']['trashed'])]
+        return self.page(items, maxResults, pageToken)
+
+    def revisions_list(self, fileId, maxResults=200, pageToken=None, **kwargs):
+        if fileId not in self.history:
+            raise self.http_error(404, f'files/{fileId}/revisions')
+        return self.page([self.signed(r) for r in self.history[fileId]], maxResults, pageToken)
+
+    def revisions_get(self, fileId, revisionId, **kwargs):
+        for r in self.history.get(fileId, []):
+            if r['id'] == revisionId:
+                return self.signed(r)
+        raise self.http_error(404, f'files/{fileId}/revisions/{revisionId}')
+
+    def changes_getStartPageToken(self, **kwargs):
+        return {'startPageToken': str(len(self.change_log) + 1)}
+
+    def changes_list(self, pageToken, maxResults=100, **kwargs):
+        start = int(pageToken) - 1
+        items = self.change_log[start:start + maxResults]
+        resp = {'items': [dict(c) for c in items]}
+        if start + maxResults < len(self.change_log):
+            resp['nextPageToken'] = str(start + maxResults + 1)
+        else:
+            resp['newStartPageToken'] = str(len(self.change_log) + 1)
+        return resp
+
+    def page(self, items, size, token):
+        start = int(token or 0)
+        resp = {'items': items[start:start + size]}
+        if start + size < len(items):
+            resp['nextPageToken'] = str(start + size)
+        return resp
+
+# files(), revisions(), changes()
+class FakeResource:
+    def __init__(self, drive, name):
+        self.drive = drive
+        self.name = name
+
+    def __getattr__(self, method):
+        handler = getattr(self.drive, f'{self.name}_{method}')
+        return lambda **kwargs: FakeRequest(self.drive, f'{self.name}.{method}', handler, kwargs)
+
+# Deferred call, like googleapiclient.http.HttpRequest
+class FakeRequest:
+    def __init__(self, drive, name, handler, kwargs):
+        self.drive = drive
+        self.name = name
+        self.handler = handler
+        self.kwargs = kwargs
+        self.methodId = f'drive.{name}'
+
+    def run(self):
+        self.drive.count(self.name)
+        return self.handler(**self.kwargs)
+
+    def execute(self):
+        self.drive.round_trip(self.name)
+        return self.run()
+
+# Batch of calls in one round-trip, like googleapiclient.http.BatchHttpRequest
+class FakeBatch:
+    def __init__(self, drive, callback=None):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self):
+        self.drive.round_trip('batch')
+        self.drive.count('batch')
+        for request_id, request, callback in self.requests:
+            # sub-requests fail on their own, as in a real batch
+            with self.drive.lock:
+                failed = self.drive.faults.random() < self.drive.error_rate
+            try:
+                if failed:
+                    raise self.drive.http_error(429, request.name)
+                response, exception = request.run(), None
+            except HttpError as error:
+                response, exception = None, error
+            if callback is not None:
+                callback(request_id, response, exception)
+
+# Download side
+class FakeCredentials:
+    token = 'fake-token'
+    valid = True
+
+class FakeResponse:
+    def __init__(self, url, status=200, data=b''):
+        self.url = url
+        self.status_code = status
+        self.content = data
+        self.headers = {'Content-Length': str(len(data))}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} for url: {self.url}', response=self)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+class FakeSession:
+    '''
+    requests.Session stand-in serving the fake's download and export links,
+    with Range requests on downloads.
+    '''
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, url, headers=None, stream=False, timeout=None, **kwargs):
+        try:
+            self.drive.round_trip('download')
+        except HttpError as error:
+            return FakeResponse(url, int(error.resp.status))
+
+        return self.serve(url, headers)
+
+    def serve(self, url, headers=None):
+        drive = self.drive
+        parsed = urllib.parse.urlparse(url)
+        kind, file_id = parsed.path.strip('/').split('/')
+        query = urllib.parse.parse_qs(parsed.query)
+        rid = query.get('revision', [None])[0]
+        if query.get('key', [str(drive.link_key)])[0] != str(drive.link_key):
+            # an expired link
+            return FakeResponse(url, 403)
+        revisions = drive.history.get(file_id)
+        if not revisions:
+            return FakeResponse(url, 404)
+        revision = next((r for r in revisions if r['id'] == rid), None) if rid else revisions[-1]
+        if revision is None:
+            return FakeResponse(url, 404)
+
+        size = drive.sizes[file_id, revision['id']]
+        if kind == 'export':
+            data = drive.export(file_id, revision['id'], size, query['exportFormat'][0])
+        else:
+            data = drive.content(file_id, revision['id'], size)
+        status = 200
+        byte_range = re.fullmatch(r'bytes=(\d+)-(\d+)', (headers or {}).get('Range', ''))
+        if byte_range and kind == 'download':
+            # exports, as on Drive, ignore ranges
+            data = data[int(byte_range.group(1)):int(byte_range.group(2)) + 1]
+            status = 206
+        with drive.lock:
+            drive.calls[kind] += 1
+            drive.bytes_served += len(data)
+
+        return FakeResponse(url, status, data)
+
+class FakeAsyncResponse:
+    # what AsyncGoogleDrive reads of an aiohttp response
+    def __init__(self, status, data):
+        self.status = status
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+    @property
+    def content(self):
+        # the aiohttp.StreamReader of the body
+        return self
+
+    async def iter_chunked(self, n):
+        for start in range(0, len(self.data), n):
+            yield self.data[start:start + n]
+
+class FakeAsyncSession:
+    '''
+    aiohttp.ClientSession stand-in serving the Drive v2 REST calls of
+    AsyncGoogleDrive and the fake's download links. Latency is awaited, so
+    concurrent requests overlap on one thread.
+    '''
+    API = 'https://www.googleapis.com/drive/v2/'
+
+    def __init__(self, drive):
+        self.drive = drive
+        self.downloads = FakeSession(drive)
+
+    def get(self, url, params=None, headers=None, **kwargs):
+        return FakeAsyncRequest(self, url, params or {}, headers or {})
+
+    async def close(self):
+        pass
+
+    def call(self, url, params):
+        path = url[len(self.API):].split('/')
+        params = {k: int(v) if k == 'maxResults' else v for k, v in params.items()}
+        if path == ['files']:
+            name, handler = 'files.list', self.drive.files_list
+        elif path == ['changes', 'startPageToken']:
+            name, handler = 'changes.getStartPageToken', self.drive.changes_getStartPageToken
+        elif len(path) == 2:
+            name, handler = 'files.get', self.drive.files_get
+            params['fileId'] = path[1]
+        elif len(path) == 3:
+            name, handler = 'revisions.list', self.drive.revisions_list
+            params['fileId'] = path[1]
+        else:
+            name, handler = 'revisions.get', self.drive.revisions_get
+            params.update(fileId=path[1], revisionId=path[3])
+
+        self.drive.count(name)
+        return json.dumps(handler(**params)).encode()
+
+class FakeAsyncRequest:
+    def __init__(self, session, url, params, headers):
+        self.session = session
+        self.url = url
+        self.params = params
+        self.headers = headers
+
+    async def __aenter__(self):
+        drive = self.session.drive
+        status = drive.fault()
+        if drive.latency:
+            await asyncio.sleep(drive.latency)
+        if status is not None:
+            return FakeAsyncResponse(status, json.dumps({'error': {'code': status, 'errors': [{'reason': 'backendError'}]}}).encode())
+
+        if not self.url.startswith(self.session.API):
+            resp = self.session.downloads.serve(self.url, self.headers)
+            return FakeAsyncResponse(resp.status_code, resp.content)
+        try:
+            return FakeAsyncResponse(200, self.session.call(self.url, self.params))
+        except HttpError as error:
+            return FakeAsyncResponse(int(error.resp.status), error.content)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
@@ -0,0 +1,82 @@
+# local imports
+import subprocess
+
+# git fast-import writer
+class FastImport:
+    '''
+    Writes blobs and commits straight into a repository's object store
+    through `git fast-import`, with no working tree or index involved.
+    Commits go on `ref` (default: the branch HEAD points to), on top of its
+    current commit if it has one.
+    '''
+    def __init__(self, repo_path, ref=None):
+        self.repo_path = repo_path
+        self.ref = ref or self.git('symbolic-ref', 'HEAD')
+        self.parent = self.git('rev-parse', '--verify', '-q', self.ref, check=False) or None
+        self.proc = subprocess.Popen(['git', 'fast-import', '--quiet', '--done'], cwd=repo_path, stdin=subprocess.PIPE)
+        self.marks = 0
+
+    def git(self, *args, check=True):
+        out = subprocess.run(['git', *args], cwd=self.repo_path, capture_output=True, text=True, check=check)
+        return out.stdout.strip()
+
+    def write(self, data):
+        self.proc.stdin.write(data)
+
+    def blob(self, chunks, size):
+        '''
+        Streams `size` bytes of content from `chunks`, returns the blob's mark.
+        '''
+        self.marks += 1
+        self.write(f'blob\nmark :{self.marks}\ndata {size}\n'.encode())
+        written = 0
+        for chunk in chunks:
+            written += len(chunk)
+            self.write(chunk)
+        if written != size:
+            raise IOError(f'Blob size mismatch: expected {size} bytes, got {written}.')
+        self.write(b'\n')
+
+        return self.marks
+
+    def quote(self, path):
+        # fast-import needs C-style quoting for paths starting with a quote or holding a newline
+        if path.startswith('"') or '\n' in path:
+            return '"' + path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        return path
+
+    def commit(self, message, name, email, date, files):
+        '''
+        Commits `files`, a list of (repo-relative path, blob mark), at the
+        timezone-aware `date` with the same author and committer.
+        '''
+        self.marks += 1
+        when = f'{int(date.timestamp())} {date.strftime("%z")}'
+        message = message.encode()
+        header = [
+            f'commit {self.ref}',
+            f'mark :{self.marks}',
+            f'author {name} <{email}> {when}',
+            f'committer {name} <{email}> {when}',
+            f'data {len(message)}'
+        ]
+        self.write(('\n'.join(header) + '\n').encode() + message + b'\n')
+        if self.parent is not None:
+            self.write(f'from {self.parent}\n'.encode())
+            self.parent = None
+        for path, mark in files:
+            self.write(f'M 100644 :{mark} {self.quote(path)}\n'.encode())
+        self.write(b'\n')
+
+        return self.marks
+
+    def abort(self):
+        # a failed blob leaves the stream unusable, nothing of this session is kept
+        self.proc.kill()
+        self.proc.wait()
+
+    def close(self):
+        self.write(b'done\n')
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f'git fast-import failed with exit code {self.proc.returncode}.')
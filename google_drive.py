@@ -1,27 +1,123 @@
 # local imports
 import io
 import os
-import requests
+import json
+import shutil
+import datetime
+import hashlib
+import tempfile
+import threading
+import collections
+import concurrent.futures
+import functools
+import httplib2
 
-# Google API imports
-from google.auth.transport.requests import Request
+# quota-aware retries and pacing
+from request_scheduler import RequestScheduler
+
+# timers and counters
+from metrics import Metrics
+
+# export formats of Google formats
+import export_formats
+
+# Google API imports (the OAuth flow, token refresh, requests and media downloads are imported when first used)
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+
+# fields read by Drive2Git and the downloaders (v2), instead of projection='FULL'
+FILE_FIELDS_V2 = ('id,title,mimeType,createdDate,modifiedDate,lastModifyingUser(displayName,emailAddress),lastModifyingUserName,'
+                  'exportLinks,downloadUrl,md5Checksum,fileSize,shortcutDetails(targetId),parents(id)')
+REVISION_FIELDS_V2 = ('id,modifiedDate,lastModifyingUser(displayName,emailAddress),lastModifyingUserName,'
+                      'exportLinks,downloadUrl,md5Checksum,fileSize')
+
+@functools.lru_cache(maxsize=None)
+def discovery_document(path=None):
+    '''
+    The Drive v2 discovery document, parsed once per process: from `path` if
+    given (e.g. a copy saved for an older client library), else the one
+    bundled with googleapiclient, so building a service never fetches it.
+    '''
+    if path is not None:
+        with open(path) as f:
+            return json.load(f)
+    from googleapiclient.discovery_cache import get_static_doc
+    return json.loads(get_static_doc('drive', 'v2'))
 
 # Google Drive class
-class GoogleDrive:
-    def __init__(self):
+class GoogleDrive(export_formats.DriveExports):
+    def __init__(self, blob_cache=None, pool_size=10, retries=3, timeout=120, scheduler=None, service=None, session=None, creds=None, metrics=None,
+                 range_threshold=64 * 1024 ** 2, part_size=16 * 1024 ** 2, part_workers=4, exports=None, normalize_exports=False,
+                 discovery_path=None, refresh_margin=300, partial_dir=None):
         # delete token.json before changing these
         self.scopes = [
             # 'https://www.googleapis.com/auth/drive.metadata.readonly',
             'https://www.googleapis.com/auth/drive.readonly'
         ]
         self.creds = None
-        self.credentials()
-        self.connect()
+        self.batch_size = 100  # Drive API limit per batch request
+        self.blob_cache = blob_cache  # drive_cache.BlobCache
+        self.timeout = timeout
+        # files of range_threshold bytes or more download in parallel parts (see download_ranges_v2)
+        self.range_threshold = range_threshold
+        self.part_size = part_size
+        self.part_workers = part_workers
+        # in-progress ranged downloads, kept out of the repository's working tree
+        if partial_dir is None:
+            partial_dir = os.path.join(blob_cache.root, 'tmp') if blob_cache is not None else os.path.join(tempfile.gettempdir(), 'drive2git-partial')
+        self.partial_dir = partial_dir
+        # Google format -> export MIME type, Office by default (e.g. exports=export_formats.TEXT_FORMATS)
+        self.export_formats = {**export_formats.OFFICE_FORMATS, **(exports or {})}
+        # zip exports (docx, xlsx, ...) rewritten to the same bytes for the same content
+        self.normalize_exports = normalize_exports
+        self.metrics = metrics or Metrics()
+        self.scheduler = scheduler or RequestScheduler(metrics=self.metrics)
+        if self.scheduler.metrics is None:
+            self.scheduler.metrics = self.metrics
+        self._local = threading.local()
+        self.discovery_path = discovery_path
+        # download session, made on first download
+        self._session = session
+        self.pool_size = pool_size
+        self.retries = retries
+        self.session_lock = threading.Lock()
+        # the access token is refreshed in the background `refresh_margin` seconds before it expires
+        self.refresh_margin = refresh_margin
+        self.token_lock = threading.Lock()
+        self.refresher = None
+        self.stop_refresh = threading.Event()
+        # a given service (e.g. fake_drive.FakeDrive) is shared by all threads and skips OAuth
+        self.shared_service = service
+        if service is None:
+            self.credentials()
+            self.connect()
+        else:
+            self.creds = creds
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self.session_lock:
+                if self._session is None:
+                    self._session = self.download_session(self.pool_size, self.retries)
+
+        return self._session
+
+    def download_session(self, pool_size, retries):
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        # keep-alive connections shared by all download threads; bad statuses are retried by the scheduler
+        session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=0.5, allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        return session
     
     def credentials(self):
         # store credentials (user access and refresh tokens)
@@ -30,27 +126,156 @@ class GoogleDrive:
         # if no (valid) credentials available, let user log in
         if not self.creds or not self.creds.valid:
             if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
+                self.refresh_token()
             else:
+                from google_auth_oauthlib.flow import InstalledAppFlow
                 flow = InstalledAppFlow.from_client_secrets_file('credentials.json', self.scopes)
                 self.creds = flow.run_local_server()  # port MUST match redirect URI in Google App
-            # save credentials for the next run
-            with open('token.json', 'w') as token:
+                self.save_token()
+        self.start_refresher()
+
+    def save_token(self):
+        # save credentials for the next run (atomically, other processes may be reading or writing it too)
+        fd, tmp_path = tempfile.mkstemp(prefix='token.json.', suffix='.tmp', dir='.')
+        try:
+            with os.fdopen(fd, 'w') as token:
                 token.write(self.creds.to_json())
+            os.replace(tmp_path, 'token.json')
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def expires_in(self):
+        # seconds left on the access token, None if unknown
+        expiry = getattr(self.creds, 'expiry', None)
+        if expiry is None:
+            return None
+        return (expiry - datetime.datetime.utcnow()).total_seconds()
+
+    def refresh_token(self, within=None):
+        # with `within`, only if the token still expires in less than that (another thread may have refreshed it)
+        from google.auth.transport.requests import Request
+        with self.token_lock:
+            if within is not None and self.expires_in() >= within:
+                return
+            self.creds.refresh(Request())
+            self.save_token()
+        self.metrics.count('auth.refresh')
+
+    def start_refresher(self):
+        if self.refresher is None and getattr(self.creds, 'refresh_token', None):
+            self.stop_refresh.clear()
+            self.refresher = threading.Thread(target=self.refresh_loop, name='token-refresh', daemon=True)
+            self.refresher.start()
+
+    def refresh_loop(self):
+        '''
+        Refreshes the access token `refresh_margin` seconds before it expires,
+        so long runs never send an expired one. Failures are retried a minute
+        later; token() still refreshes on demand meanwhile.
+        '''
+        while True:
+            left = self.expires_in()
+            wait = 60 if left is None else max(0, left - self.refresh_margin)
+            if self.stop_refresh.wait(wait):
+                return
+            if left is None:
+                continue
+            try:
+                self.refresh_token()
+            except Exception as exception:
+                print(f'Token refresh failed: {exception}')
+                if self.stop_refresh.wait(60):
+                    return
+
+    def token(self):
+        '''
+        A valid access token, refreshed now if the background refresh hasn't.
+        '''
+        left = self.expires_in()
+        if left is not None and left < 60 and getattr(self.creds, 'refresh_token', None):
+            self.refresh_token(within=60)
+
+        return self.creds.token
+
+    def close(self):
+        # stops the background token refresh; calls still work, refreshing on demand
+        self.stop_refresh.set()
+        if self.refresher is not None:
+            self.refresher.join()
+            self.refresher = None
                 
     def connect(self):
         # attempt to connect to the API
         try:
-            self.service = build('drive', 'v2', credentials=self.creds) # used to retrieve all revision author and to export google workspace 
+            # each thread keeps its own authorized keep-alive connection
+            http = AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout))
+            self._local.service = build_from_document(discovery_document(self.discovery_path), http=http) # used to retrieve all revision author and to export google workspace 
             # self.service = build('gmail', 'v1', credentials=self.creds)  # use later for gmail...
         except HttpError as error:
             print(f'An error occurred: {error}')
+
+        return getattr(self._local, 'service', None)
+
+    @property
+    def service(self):
+        if self.shared_service is not None:
+            return self.shared_service
+        # httplib2 clients are not thread-safe, so each thread gets its own
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self.connect()
+
+        return service
             
+    def execute(self, request):
+        self.metrics.count(f'api.{request.methodId}')
+        return self.scheduler.call(request.execute)
+
+    def batch_execute(self, calls):
+        '''
+        Sends API requests as Drive batch HTTP requests, `batch_size` calls per
+        round-trip. Responses come back in input order, None for failed calls.
+        Calls failing on quota or server errors are sent again after a backoff.
+        '''
+        responses = [None] * len(calls)
+        pending = list(range(len(calls)))
+        attempt = 0
+
+        while pending:
+            retry = []
+            limited = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[int(request_id)] = response
+                elif self.scheduler.retryable(exception):
+                    retry.append(int(request_id))
+                    if self.scheduler.rate_limited(exception):
+                        limited.append(int(request_id))
+
+            for start in range(0, len(pending), self.batch_size):
+                chunk = pending[start:start + self.batch_size]
+                batch = self.service.new_batch_http_request(callback=callback)
+                for n in chunk:
+                    batch.add(calls[n], request_id=str(n))
+                    self.metrics.count(f'api.{calls[n].methodId}')
+                self.metrics.count('api.batch')
+                self.scheduler.call(batch.execute, cost=len(chunk))
+
+            if not retry or attempt >= self.scheduler.max_retries:
+                break
+            self.scheduler.backoff(attempt, bool(limited))
+            attempt += 1
+            pending = sorted(retry)
+
+        return responses
+
     def id_get(self, i):
-        r = self.service.files().get(fileId=i).execute()
+        r = self.execute(self.service.files().get(fileId=i))
         
         return r
-            
+
     def id_search(self, values, term='name', operator='=', ftype='file', ignore_trashed=True):
         q = f'{term} {operator} "{values}" '
         if ftype == 'folder':
@@ -59,7 +284,7 @@ class GoogleDrive:
             q += 'and mimeType = "application/json" '
         if ignore_trashed:
             q += 'and trashed = false'
-        l = self.service.files().list(q=q).execute()
+        l = self.execute(self.service.files().list(q=q))
         
         return l['files']
             
@@ -75,7 +300,7 @@ class GoogleDrive:
         first_pass = True
         while first_pass or page_token:
             first_pass = False
-            resp = self.service.files().list(q=q, fields=fields_str, pageToken=page_token).execute()
+            resp = self.execute(self.service.files().list(q=q, fields=fields_str, pageToken=page_token))
             files.extend(resp.get('files', []))
             page_token = resp.get('nextPageToken')
 
@@ -92,20 +317,56 @@ class GoogleDrive:
 
         while first_pass or page_token:
             first_pass = False
-            resp = self.service.files().list(q=q, projection='FULL', pageToken=page_token).execute()
+            resp = self.execute(self.service.files().list(q=q, fields=f'nextPageToken,items({FILE_FIELDS_V2})', maxResults=1000, pageToken=page_token))
             files .extend(resp.get('items', []))
             page_token = resp.get('nextPageToken')
 
         return files
             
+    def list_all_v2(self, drive_id=None):
+        '''
+        Every non-trashed item of the user's corpus, or of the shared drive
+        `drive_id`, in 1000-item pages.
+        '''
+        corpus = {'corpora': 'drive', 'driveId': drive_id} if drive_id else {}
+        files = []
+        page_token = None
+        first_pass = True
+
+        while first_pass or page_token:
+            first_pass = False
+            resp = self.execute(self.service.files().list(q='trashed = false', fields=f'nextPageToken,items({FILE_FIELDS_V2})', maxResults=1000,
+                                                          pageToken=page_token, supportsAllDrives=True, includeItemsFromAllDrives=True, **corpus))
+            files.extend(resp.get('items', []))
+            page_token = resp.get('nextPageToken')
+
+        return files
+
+    def get_start_page_token_v2(self):
+        return self.execute(self.service.changes().getStartPageToken(supportsAllDrives=True))['startPageToken']
+
+    def list_changes_v2(self, page_token):
+        '''
+        All changes since `page_token`, and the token to list from next time.
+        '''
+        changes = []
+        while True:
+            resp = self.execute(self.service.changes().list(pageToken=page_token, includeDeleted=True, maxResults=1000,
+                                                            supportsAllDrives=True, includeItemsFromAllDrives=True,
+                                                            fields=f'nextPageToken,newStartPageToken,items(fileId,deleted,modificationDate,file({FILE_FIELDS_V2},labels(trashed)))'))
+            changes.extend(resp.get('items', []))
+            page_token = resp.get('nextPageToken')
+            if not page_token:
+                return changes, resp.get('newStartPageToken')
+
     def get_shortcut_target_v3(self, shortcut_id):
         # Récupère les informations sur la cible du shortcut
-        file = self.service.files().get(fileId=shortcut_id, fields="shortcutDetails/targetId", supportsAllDrives=True).execute()
+        file = self.execute(self.service.files().get(fileId=shortcut_id, fields="shortcutDetails/targetId", supportsAllDrives=True))
         target_id = file.get('shortcutDetails', {}).get('targetId', None)
         if target_id:
             # Récupère le fichier cible
             try:
-                target_file = self.service.files().get(fileId=target_id, fields='id,name,mimeType,createdTime,modifiedTime,lastModifyingUser(displayName,emailAddress)', supportsAllDrives=True).execute()
+                target_file = self.execute(self.service.files().get(fileId=target_id, fields='id,name,mimeType,createdTime,modifiedTime,lastModifyingUser(displayName,emailAddress)', supportsAllDrives=True))
                 return target_file
             except HttpError as error:
                 print(f"Erreur lors de la récupération du fichier cible : {error}")
@@ -115,12 +376,12 @@ class GoogleDrive:
         
     def get_shortcut_target_v2(self, shortcut_id):
         # Récupère les informations sur la cible du shortcut
-        file = self.service.files().get(fileId=shortcut_id, fields="shortcutDetails/targetId", supportsAllDrives=True).execute()
+        file = self.execute(self.service.files().get(fileId=shortcut_id, fields="shortcutDetails/targetId", supportsAllDrives=True))
         target_id = file.get('shortcutDetails', {}).get('targetId', None)
         if target_id:
             # Récupère le fichier cible
             try:
-                target_file = self.service.files().get(fileId=target_id, projection='FULL', supportsAllDrives=True).execute()
+                target_file = self.execute(self.service.files().get(fileId=target_id, fields=FILE_FIELDS_V2, supportsAllDrives=True))
                 return target_file
             except HttpError as error:
                 print(f"Erreur lors de la récupération du fichier cible : {error}")
@@ -128,6 +389,24 @@ class GoogleDrive:
         else:
             return None
 
+    def get_shortcut_targets_v2_batch(self, ids, target_ids=None):
+        '''
+        Batched get_shortcut_target_v2, returns {shortcut id: target or None}.
+        Known `target_ids` ({shortcut id: target id}, e.g. from a listing's
+        shortcutDetails) save the first lookup.
+        '''
+        target_ids = dict(target_ids or {})
+        unknown = [i for i in ids if not target_ids.get(i)]
+        shortcuts = self.batch_execute([self.service.files().get(fileId=i, fields="shortcutDetails/targetId", supportsAllDrives=True) for i in unknown])
+        target_ids.update({i: (s or {}).get('shortcutDetails', {}).get('targetId') for i, s in zip(unknown, shortcuts)})
+        target_ids = {i: target_ids.get(i) for i in ids}
+
+        wanted = sorted(set(t for t in target_ids.values() if t))
+        targets = self.batch_execute([self.service.files().get(fileId=t, fields=FILE_FIELDS_V2, supportsAllDrives=True) for t in wanted])
+        targets = dict(zip(wanted, targets))
+
+        return {i: targets.get(t) for i, t in target_ids.items()}
+
     def get_revisions_v3(self, i):
         revisions = []
         page_token = None
@@ -136,11 +415,12 @@ class GoogleDrive:
         while first_pass or page_token:
             first_pass = False
             try:
-                resp = self.service.revisions().list(fileId=i, pageToken=page_token).execute()
-                revisions.extend(resp.get('revisions', []))
-                page_token = resp.get('nextPageToken')
-            except:
-                continue
+                resp = self.execute(self.service.revisions().list(fileId=i, pageToken=page_token))
+            except HttpError:
+                # e.g. revisions not readable, keep what was listed
+                break
+            revisions.extend(resp.get('revisions', []))
+            page_token = resp.get('nextPageToken')
 
         return revisions
         
@@ -152,19 +432,60 @@ class GoogleDrive:
         while first_pass or page_token:
             first_pass = False
             try:
-                resp = self.service.revisions().list(fileId=i, pageToken=page_token).execute()
-                revisions.extend(resp.get('items', []))
-                page_token = resp.get('nextPageToken')
-            except:
-                continue
+                resp = self.execute(self.service.revisions().list(fileId=i, pageToken=page_token, fields=f'nextPageToken,items({REVISION_FIELDS_V2})'))
+            except HttpError:
+                # e.g. revisions not readable: None, not a partial list that could be cached
+                return None
+            revisions.extend(resp.get('items', []))
+            page_token = resp.get('nextPageToken')
 
         return revisions
         
+    def get_revisions_v2_batch(self, ids):
+        '''
+        Batched get_revisions_v2, returns {file id: revisions}, None for files
+        whose lookup failed. Files with more than one page of revisions are
+        paged together in follow-up batches.
+        '''
+        revisions = {i: [] for i in ids}
+        page_tokens = {i: None for i in ids}
+
+        while page_tokens:
+            keys = list(page_tokens)
+            resps = self.batch_execute([self.service.revisions().list(fileId=i, pageToken=page_tokens[i], fields=f'nextPageToken,items({REVISION_FIELDS_V2})') for i in keys])
+            page_tokens = {}
+            for i, resp in zip(keys, resps):
+                if resp is None:
+                    revisions[i] = None
+                    continue
+                revisions[i].extend(resp.get('items', []))
+                if resp.get('nextPageToken'):
+                    page_tokens[i] = resp['nextPageToken']
+
+        return revisions
+
+    def links_request_v2(self, f):
+        # exportLinks (Google formats) and downloadUrl (everything else) of a file or revision
+        if f['rid']:
+            return self.service.revisions().get(fileId=f['id'], revisionId=f['rid'], fields='exportLinks,downloadUrl')
+        else:
+            return self.service.files().get(fileId=f['id'], fields='exportLinks,downloadUrl', supportsAllDrives=True)
+
+    def prefetch_links_v2(self, changes):
+        '''
+        Looks up the download links of many changes in batches and stores them
+        on each change, so stream_file_v2 can skip its own metadata request.
+        '''
+        missing = [c for c in changes if not self.has_links(c)]
+        for c, links in zip(missing, self.batch_execute([self.links_request_v2(c) for c in missing])):
+            if links:
+                self.keep_links(c, links)
+
     def qry_fields(self, i, r=None, fields=['parents']):
         if r is None:
-            p = self.service.files().get(fileId=i, fields=','.join(fields), supportsAllDrives=True).execute()
+            p = self.execute(self.service.files().get(fileId=i, fields=','.join(fields), supportsAllDrives=True))
         else:
-            p = self.service.revisions().get(fileId=i, revisionId=r, fields=','.join(fields), supportsAllDrives=True).execute()
+            p = self.execute(self.service.revisions().get(fileId=i, revisionId=r, fields=','.join(fields), supportsAllDrives=True))
         
         return {f: p[f] for f in fields}
     
@@ -194,12 +515,13 @@ class GoogleDrive:
             stream = io.BytesIO()
         else:
             stream = io.FileIO(out, mode='w')
+        from googleapiclient.http import MediaIoBaseDownload
         downloader = MediaIoBaseDownload(stream, request)
 
         try:
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = self.scheduler.call(downloader.next_chunk)
                 if verbose:
                     print(f'Download {int(status.progress() * 100)}%')
             if verbose:
@@ -217,59 +539,263 @@ class GoogleDrive:
         else:
             return stream
 
-    def stream_file_v2(self, f, out='stream', verbose=False):
-        mime = f['type']
-        file_id = f['id']
-        rev_id = f['rid']
+    def download_url_v2(self, f, fresh=False):
+        # links listed or prefetched by prefetch_links_v2, else (or if `fresh`) one request for them
+        if fresh or not self.has_links(f):
+            self.keep_links(f, self.execute(self.links_request_v2(f)))
 
-        export_map = {
-            'application/vnd.google-apps.document': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',  # .docx
-            'application/vnd.google-apps.spreadsheet': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',     # .xlsx
-            'application/vnd.google-apps.presentation': 'application/vnd.openxmlformats-officedocument.presentationml.presentation',  # .pptx
-        }
+        return self.link_v2(f, f)
 
-        export_native_map = {
-            'application/vnd.google-apps.document': 'docx',
-            'application/vnd.google-apps.spreadsheet': 'xlsx',
-            'application/vnd.google-apps.presentation': 'pptx',
-            'application/vnd.google-apps.drawing': 'png',
-        }
+    def with_link_v2(self, f, fn, *args):
+        '''
+        fn(url, *args) through the scheduler, `url` being the download link
+        of `f`. A link from a listing, the metadata cache or a journal may
+        have expired since: if Drive turns it down, it is looked up again, once.
+        '''
+        listed = self.has_links(f)
+        try:
+            return self.scheduler.call(fn, self.download_url_v2(f), *args)
+        except Exception as error:
+            if not listed or not self.stale_link(error):
+                raise
+        self.metrics.count('download.stale_links')
 
-        format = export_native_map.get(mime)
+        return self.scheduler.call(fn, self.download_url_v2(f, fresh=True), *args)
 
-        if format:
-            if rev_id:
-                export_links = self.service.revisions().get(fileId=file_id, revisionId=rev_id, fields='exportLinks').execute().get('exportLinks')
-                url = export_links[export_map[mime]]
+    def open_content_v2(self, f, chunk_size=32768):
+        '''
+        Size (None if unknown) and chunks of a file's content, straight from
+        Drive. With normalize_exports, zip exports are normalized (see
+        export_formats.normalize_zip), which reads them whole; Drive caps
+        exports at 10 MB.
+        '''
+        resp = self.open_stream_v2(f)
+        if self.normalizes(f):
+            data = export_formats.normalize_zip(resp.content)
+            self.count_download(len(resp.content))
+            return len(data), iter([data[i:i + chunk_size] for i in range(0, len(data), chunk_size)])
 
-                url += f'&revision={rev_id}'
-            else:
-                export_links = self.service.files().get(fileId=file_id, fields='exportLinks').execute().get('exportLinks')
-                url = export_links[export_map[mime]]
-        else:
-            if rev_id:
-                url = self.service.revisions().get(fileId=file_id, revisionId=rev_id, fields='downloadUrl').execute().get('downloadUrl')
-            else:
-                url = self.service.files().get(fileId=file_id, fields='downloadUrl', supportsAllDrives=True).execute().get('downloadUrl')
+        def chunks():
+            size = 0
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                yield chunk
+            self.count_download(size)
 
-        headers = {'Authorization': f'Bearer {self.creds.token}'}
-        resp = requests.get(url, headers=headers, stream=True)
+        size = resp.headers.get('Content-Length')
+        if size is None or resp.headers.get('Content-Encoding'):
+            return None, chunks()
+
+        return int(size), chunks()
+
+    def count_download(self, size):
+        self.metrics.count('download.files')
+        self.metrics.count('download.bytes', size)
+
+    def get_stream(self, url):
+        headers = {'Authorization': f'Bearer {self.token()}'}
+        resp = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
         resp.raise_for_status()
 
+        return resp
+
+    def get_range(self, url, start, end):
+        # bytes start..end-1, read whole so a dropped connection fails (and is retried) here
+        headers = {'Authorization': f'Bearer {self.token()}', 'Range': f'bytes={start}-{end - 1}'}
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            raise RuntimeError(f'Range request not honored (status {resp.status_code}).')
+        data = resp.content
+        if len(data) != end - start:
+            # a dropped connection, retried like one
+            raise ConnectionError(f'Short range: expected {end - start} bytes, got {len(data)}.')
+        self.metrics.count('download.parts')
+        self.metrics.count('download.bytes', len(data))
+
+        return data
+
+    def ranged(self, f):
+        # only plain downloads have a size and take ranges, not exports
+        return int(f.get('fileSize') or 0) >= self.range_threshold and f['type'] not in self.export_formats
+
+    def download_ranges_v2(self, f, out):
+        '''
+        Downloads a large file to `out` in `part_size` Range requests,
+        `part_workers` at a time, and returns its md5. Parts are written in
+        place into a preallocated <id>-<rid>.partial in `partial_dir`, and the
+        parts done are listed in <id>-<rid>.partial.json, so a failed download
+        resumes with the parts still missing (if `part_size` is unchanged).
+        Parts are hashed in order as they arrive (resumed ones are read back);
+        a checksum that differs from Drive's discards the file.
+        '''
+        size = int(f['fileSize'])
+        os.makedirs(self.partial_dir, exist_ok=True)
+        partial = os.path.join(self.partial_dir, f'{f["id"]}-{f["rid"]}.partial')
+        state_path = partial + '.json'
+        key = [f['id'], f['rid'], size, self.part_size]
+
+        done = set()
+        if os.path.exists(partial) and os.path.exists(state_path):
+            with open(state_path) as state:
+                state = json.load(state)
+            if state['key'] == key:
+                done = set(state['done'])
+                print(f'\t\tResuming download, {len(done)} parts done')
+
+        parts = [(n, start, min(start + self.part_size, size)) for n, start in enumerate(range(0, size, self.part_size))]
+        lock = threading.Lock()
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if not done:
+                os.ftruncate(fd, 0)
+                if hasattr(os, 'posix_fallocate') and size:
+                    os.posix_fallocate(fd, 0, size)
+                else:
+                    os.ftruncate(fd, size)
+
+            def fetch(part):
+                n, start, end = part
+                if n in done:
+                    return os.pread(fd, end - start, start)
+                data = self.with_link_v2(f, self.get_range, start, end)
+                os.pwrite(fd, data, start)
+                with lock:
+                    done.add(n)
+                    with open(state_path + '.tmp', 'w') as state:
+                        json.dump({'key': key, 'done': sorted(done)}, state)
+                    os.replace(state_path + '.tmp', state_path)
+                return data
+
+            # a sliding window of parts, so memory holds at most 2 * part_workers of them
+            md5 = hashlib.md5()
+            window = 2 * self.part_workers
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.part_workers) as pool:
+                pending = collections.deque(pool.submit(fetch, part) for part in parts[:window])
+                following = iter(parts[window:])
+                try:
+                    while pending:
+                        md5.update(pending.popleft().result())
+                        part = next(following, None)
+                        if part is not None:
+                            pending.append(pool.submit(fetch, part))
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+
+        if f.get('md5Checksum') and md5.hexdigest() != f['md5Checksum']:
+            os.remove(partial)
+            os.remove(state_path)
+            raise IOError(f'Checksum mismatch for {f["id"]}: expected {f["md5Checksum"]}, got {md5.hexdigest()}.')
+        shutil.move(partial, out)
+        os.remove(state_path)
+        self.metrics.count('download.files')
+
+        return md5.hexdigest()
+
+    def open_stream_v2(self, f):
+        return self.with_link_v2(f, self.get_stream)
+
+    def cached_file_v2(self, f, verbose=False):
+        '''
+        Path of a revision in the blob cache, downloaded into it on a miss.
+        '''
+        rid = self.cache_rid(f)
+        path = self.blob_cache.lookup(f['id'], rid, f.get('md5Checksum'))
+        if path is None and self.ranged(f):
+            self.metrics.count('cache.blob.miss')
+            # next to the cache, so adding it is a rename
+            tmp_path = os.path.join(self.blob_cache.root, 'tmp', f'{f["id"]}-{f["rid"]}')
+            md5 = self.download_ranges_v2(f, tmp_path)
+            path = self.blob_cache.add(f['id'], rid, tmp_path, md5, int(f['fileSize']))
+        elif path is None:
+            self.metrics.count('cache.blob.miss')
+            size, chunks = self.open_content_v2(f)
+            with self.blob_cache.writer(f['id'], rid) as blob:
+                for chunk in chunks:
+                    blob.write(chunk)
+            path = blob.path
+        else:
+            self.metrics.count('cache.blob.hit')
+            if verbose:
+                print(f'Cached {path}')
+
+        return path
+
+    def iter_file_v2(self, f, chunk_size=32768):
+        '''
+        Size and chunks of a file's content, for writers that don't need a
+        local copy. Size is None when the server doesn't give a usable length.
+        '''
+        if self.blob_cache is not None and f['rid']:
+            path = self.cached_file_v2(f)
+            def chunks():
+                with open(path, 'rb') as cached:
+                    while True:
+                        chunk = cached.read(chunk_size)
+                        if not chunk:
+                            return
+                        yield chunk
+            return os.path.getsize(path), chunks()
+
+        if self.ranged(f):
+            path = os.path.join(tempfile.gettempdir(), f'drive2git-{f["id"]}-{f["rid"]}')
+            self.download_ranges_v2(f, path)
+            def chunks():
+                try:
+                    with open(path, 'rb') as downloaded:
+                        while True:
+                            chunk = downloaded.read(chunk_size)
+                            if not chunk:
+                                return
+                            yield chunk
+                finally:
+                    os.remove(path)
+            return int(f['fileSize']), chunks()
+
+        return self.open_content_v2(f, chunk_size)
+
+    def stream_file_v2(self, f, out='stream', verbose=False):
+        # revisions never change, so they can be served from the blob cache
+        if self.blob_cache is not None and f['rid']:
+            path = self.cached_file_v2(f, verbose=verbose)
+
+            if out in ['stream', 'str']:
+                with open(path, 'rb') as cached:
+                    data = cached.read()
+                return data if out == 'str' else io.BytesIO(data)
+            shutil.copyfile(path, out)
+            return out
+
+        if out not in ['stream', 'str'] and self.ranged(f):
+            self.download_ranges_v2(f, out)
+            return out
+
+        size, chunks = self.open_content_v2(f)
+
         if out in ['stream', 'str']:
             stream = io.BytesIO()
         else:
             stream = io.FileIO(out, mode='w')
 
         # Lecture par morceaux
-        for chunk in resp.iter_content(chunk_size=32768):
-            if not chunk:
-                continue
-            stream.write(chunk)
-            if verbose:
-                print(f'Downloaded {len(chunk)} bytes')
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                stream.write(chunk)
+                if verbose:
+                    print(f'Downloaded {len(chunk)} bytes')
+        finally:
+            if out not in ['stream', 'str']:
+                stream.close()
 
         if out in ['str']:
             return stream.getvalue()
+        elif out == 'stream':
+            return stream
         else:
-            return stream
\ No newline at end of file
+            return out
\ No newline at end of file
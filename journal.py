@@ -0,0 +1,66 @@
+# local imports
+import os
+import json
+import shutil
+import datetime
+
+# compact revision records
+from revision_record import Revision
+
+# Checkpoints of a make_repo run
+class Journal:
+    '''
+    What a make_repo run needs to resume: the crawl snapshot and the commit
+    plan, written once, then after each checkpoint the index of the next
+    bundle to write and the HEAD commit the run had reached. Kept in a
+    directory next to the repository, since make_repo deletes .git.
+
+    The index backend checkpoints after every bundle, fast-import every
+    `every` bundles (it has to be closed to make its commits durable).
+    '''
+    def __init__(self, path, every=100):
+        self.path = path
+        self.every = every
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        return os.path.exists(self.file('progress.json'))
+
+    def dump(self, name, data):
+        # written aside then renamed, a crash never leaves a torn file
+        tmp = self.file(name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.file(name))
+
+    def load_file(self, name):
+        with open(self.file(name)) as f:
+            return json.load(f)
+
+    def start(self, snapshot, bundles):
+        self.clear()
+        os.makedirs(self.path)
+        self.dump('snapshot.json', snapshot)
+        self.dump('plan.json', [(cdate.isoformat(), name, email, [c.to_dict() for c in changes])
+                                for cdate, name, email, changes in bundles])
+        # progress last: it marks the journal as complete
+        self.checkpoint(0, None)
+
+    def checkpoint(self, next_bundle, head):
+        self.dump('progress.json', {'next': next_bundle, 'head': head})
+
+    def load(self):
+        '''
+        (snapshot, bundles, progress) of the journaled run.
+        '''
+        files = {}
+        bundles = [(datetime.datetime.fromisoformat(cdate), name, email, [Revision.from_dict(c, files) for c in changes])
+                   for cdate, name, email, changes in self.load_file('plan.json')]
+
+        return self.load_file('snapshot.json'), bundles, self.load_file('progress.json')
+
+    def clear(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
@@ -0,0 +1,99 @@
+# local imports
+import os
+import re
+import shutil
+import hashlib
+import tempfile
+
+POINTER_VERSION = 'version https://git-lfs.github.com/spec/v1'
+
+# Git LFS objects of a repository
+class LfsStore:
+    '''
+    Local Git LFS object store (`.git/lfs/objects/aa/bb/<sha256>`) for large
+    files: the commit gets a small pointer file instead of the content, and
+    git-lfs serves the content from here, with no LFS server needed to
+    convert. Files of `threshold` bytes or more (by Drive's fileSize) and
+    files of `mime_types` go to the store.
+    '''
+    def __init__(self, lfs_path, threshold=None, mime_types=[]):
+        self.lfs_path = lfs_path
+        self.threshold = threshold
+        self.mime_types = set(mime_types)
+
+    def wants(self, change):
+        # exports have no fileSize, only their MIME type can select them
+        size = int(change.get('fileSize') or 0)
+        return (self.threshold is not None and size >= self.threshold) or change['type'] in self.mime_types
+
+    def object_path(self, oid):
+        return os.path.join(self.lfs_path, 'objects', oid[:2], oid[2:4], oid)
+
+    def store(self, chunks):
+        '''
+        Stores content from `chunks`, returns its (oid, size).
+        '''
+        tmp_dir = os.path.join(self.lfs_path, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        sha = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+            for chunk in chunks:
+                sha.update(chunk)
+                size += len(chunk)
+                tmp.write(chunk)
+        oid = sha.hexdigest()
+        path = self.object_path(oid)
+        if os.path.exists(path):
+            os.remove(tmp.name)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp.name, path)
+
+        return oid, size
+
+    def pointer(self, oid, size):
+        return f'{POINTER_VERSION}\noid sha256:{oid}\nsize {size}\n'.encode()
+
+    def smudge(self, file_path):
+        '''
+        Replaces a pointer file by its content, if the store has it.
+        '''
+        if os.path.getsize(file_path) > 1024:
+            return False
+        with open(file_path, 'rb') as f:
+            lines = f.read().decode(errors='replace').splitlines()
+        if len(lines) < 3 or lines[0] != POINTER_VERSION or not lines[1].startswith('oid sha256:'):
+            return False
+        path = self.object_path(lines[1][len('oid sha256:'):])
+        if not os.path.exists(path):
+            return False
+        shutil.copyfile(path, file_path)
+
+        return True
+
+    @staticmethod
+    def pattern(path):
+        # anchored, with glob characters escaped, C-quoted when it holds spaces or quotes
+        pattern = '/' + re.sub(r'([\\*?\[])', r'\\\1', path)
+        if re.search(r'[\s"]', pattern):
+            return '"' + pattern.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        return pattern
+
+    @staticmethod
+    def unpattern(pattern):
+        if pattern.startswith('"'):
+            pattern = re.sub(r'\\(.)', r'\1', pattern[1:-1])
+        return re.sub(r'\\(.)', r'\1', pattern)[1:]
+
+    def attributes_lines(self, paths):
+        return [f'{self.pattern(p)} filter=lfs diff=lfs merge=lfs -text\n' for p in sorted(paths)]
+
+    def read_attributes(self, file_path):
+        '''
+        Paths tracked by LFS in a .gitattributes written by attributes_lines.
+        '''
+        if not os.path.exists(file_path):
+            return set()
+        with open(file_path) as f:
+            return {self.unpattern(line.rsplit(' filter=lfs', 1)[0]) for line in f if line.endswith(' filter=lfs diff=lfs merge=lfs -text\n')}
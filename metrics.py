@@ -0,0 +1,120 @@
+# local imports
+import os
+import re
+import json
+import time
+import threading
+import contextlib
+import collections
+
+# Run instrumentation
+class Metrics:
+    '''
+    Phase timers and event counters of a run, shared by GoogleDrive and
+    Drive2Git. A phase timed inside another one (e.g. download inside
+    commit) is taken out of the outer phase, so phases add up to the wall
+    time of the thread that ran them.
+
+    Hooks are called as hook(kind, name, value) on every 'phase' end
+    (seconds) and 'count' (increment).
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = collections.Counter()
+        self.counters = collections.Counter()
+        self.hooks = []
+        self._local = threading.local()
+        self.started = time.time()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+        return hook
+
+    def notify(self, kind, name, value):
+        for hook in self.hooks:
+            hook(kind, name, value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+        if self.hooks:
+            self.notify('count', name, n)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)  # time spent in nested phases
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            seconds = elapsed - stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.phases[name] += seconds
+            if self.hooks:
+                self.notify('phase', name, seconds)
+
+    def mark(self):
+        # a point to report a run from, see since
+        with self.lock:
+            return time.time(), collections.Counter(self.phases), collections.Counter(self.counters)
+
+    def since(self, mark):
+        '''
+        Metrics of what was timed and counted after `mark`, e.g. one run on a
+        drive whose metrics outlive it.
+        '''
+        started, phases, counters = mark
+        run = Metrics()
+        run.started = started
+        with self.lock:
+            run.phases = self.phases - phases
+            run.counters = self.counters - counters
+
+        return run
+
+    def summary(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'seconds': time.time() - self.started,
+                'phases': dict(self.phases),
+                'counters': dict(self.counters)
+            }
+
+    def report(self):
+        summary = self.summary()
+        lines = [f'{name:12} {seconds:10.2f}s' for name, seconds in sorted(summary['phases'].items(), key=lambda p: -p[1])]
+        lines += [f'{name:40} {value:10}' for name, value in sorted(summary['counters'].items())]
+        return '\n'.join(lines)
+
+    def prometheus(self, prefix='drive2git'):
+        summary = self.summary()
+        lines = [f'# TYPE {prefix}_phase_seconds gauge']
+        lines += [f'{prefix}_phase_seconds{{phase="{name}"}} {seconds:.6f}' for name, seconds in sorted(summary['phases'].items())]
+        lines += [f'# TYPE {prefix}_api_calls_total counter']
+        lines += [f'{prefix}_api_calls_total{{method="{name[4:]}"}} {value}' for name, value in sorted(summary['counters'].items())
+                  if name.startswith('api.')]
+        for name, value in sorted(summary['counters'].items()):
+            if not name.startswith('api.'):
+                metric = f'{prefix}_{re.sub(r"[^a-zA-Z0-9_]", "_", name)}_total'
+                lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+        lines += [f'# TYPE {prefix}_run_seconds gauge', f'{prefix}_run_seconds {summary["seconds"]:.6f}']
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        '''
+        Prometheus textfile for a .prom path, JSON summary otherwise. The file
+        is replaced atomically, so collectors never read it half-written.
+        '''
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
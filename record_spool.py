@@ -0,0 +1,58 @@
+# local imports
+import json
+import sqlite3
+
+# On-disk spool of crawl records
+class RecordSpool:
+    '''
+    Flat crawl records (folders, files, revisions) spilled to SQLite, so a
+    crawl never holds the whole tree in memory. Revisions read back sorted by
+    date, in the order they were added within a date, and each (file id,
+    revision id, date) is kept once.
+    '''
+    def __init__(self, path='crawl_spool.sqlite', buffer_size=1000):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = {'items': [], 'revisions': []}
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS items (seq INTEGER PRIMARY KEY, kind TEXT, id TEXT, parent TEXT, data TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS revisions (seq INTEGER PRIMARY KEY, date TEXT, id TEXT, rid TEXT, data TEXT, UNIQUE (id, rid, date))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS revisions_by_date ON revisions (date, seq)')
+        self.db.commit()
+
+    def clear(self):
+        self.buffer = {'items': [], 'revisions': []}
+        self.db.execute('DELETE FROM items')
+        self.db.execute('DELETE FROM revisions')
+        self.db.commit()
+
+    def add(self, kind, record, parent=None):
+        # records are plain dicts (see Revision.to_dict)
+        if kind == 'revision':
+            # rid None must still dedup, so it is stored as ''
+            self.buffer['revisions'].append((record['modifiedTime'], record['id'], record['rid'] or '', json.dumps(record)))
+        else:
+            self.buffer['items'].append((kind, record['id'], parent, json.dumps(record)))
+        if len(self.buffer['revisions']) + len(self.buffer['items']) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany('INSERT INTO items (kind, id, parent, data) VALUES (?, ?, ?, ?)', self.buffer['items'])
+        self.db.executemany('INSERT OR IGNORE INTO revisions (date, id, rid, data) VALUES (?, ?, ?, ?)', self.buffer['revisions'])
+        self.db.commit()
+        self.buffer = {'items': [], 'revisions': []}
+
+    def items(self, kind):
+        for parent, data in self.db.execute('SELECT parent, data FROM items WHERE kind = ? ORDER BY seq', (kind,)):
+            yield json.loads(data), parent
+
+    def revisions(self):
+        '''
+        (date, revision) pairs, oldest first.
+        '''
+        for date, data in self.db.execute('SELECT date, data FROM revisions ORDER BY date, seq'):
+            yield date, json.loads(data)
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,183 @@
+# local imports
+import json
+import asyncio
+import multiprocessing
+import random
+import threading
+import time
+
+# Token bucket shared by all Drive calls
+class TokenBucket:
+    '''
+    Lets through `rate` requests per second on average, with bursts of up to
+    `capacity`. The rate adapts: it is halved on every quota error and grows
+    back by `recovery` requests per second on every success, up to `max_rate`.
+    '''
+    def __init__(self, rate=200.0, capacity=None, min_rate=1.0, recovery=0.5):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n=1):
+        # take the tokens now (possibly going negative), returns how long to wait for the debt
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self, n=1):
+        wait = self.take(n)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, n=1):
+        wait = self.take(n)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def penalize(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def reward(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+
+# Token bucket shared by processes
+class SharedTokenBucket(TokenBucket):
+    '''
+    TokenBucket kept in shared memory, so every process it is handed to
+    when started (e.g. through a pool initializer) draws from one quota.
+    '''
+    def __init__(self, rate=200.0, capacity=None, min_rate=1.0, recovery=0.5, context=multiprocessing):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.capacity = capacity or rate
+        self.lock = context.Lock()
+        # rate, tokens, stamp (time.monotonic is system-wide)
+        self.state = context.RawArray('d', [rate, self.capacity, time.monotonic()])
+
+    def shared(index):
+        return property(lambda self: self.state[index], lambda self, value: self.state.__setitem__(index, value))
+
+    rate = shared(0)
+    tokens = shared(1)
+    stamp = shared(2)
+    del shared
+
+# Retries and pacing of Drive calls
+class RequestScheduler:
+    '''
+    Runs every Drive API and download call through a token bucket (default:
+    Drive's per-user quota of 12,000 queries per minute). Quota errors (403
+    rate limits, 429), 5xx responses and transport errors are retried after
+    a jittered exponential backoff, at most `max_retries` times; only quota
+    errors also halve the bucket's rate. Retries are counted on
+    `metrics` (a metrics.Metrics) when given.
+    '''
+    RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded'}
+
+    def __init__(self, bucket=None, max_retries=6, base_delay=1.0, max_delay=64.0, metrics=None):
+        self.bucket = bucket or TokenBucket(rate=12000 / 60)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0
+        self.metrics = metrics
+
+    def status(self, error):
+        # googleapiclient HttpError has .resp, requests HTTPError has .response, aiohttp errors .status
+        resp = getattr(error, 'resp', None)
+        if resp is not None:
+            return int(resp.status), getattr(error, 'content', b'')
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return int(response.status_code), response.content
+        status = getattr(error, 'status', None)
+        if isinstance(status, int):
+            return status, getattr(error, 'content', b'')
+        return None, b''
+
+    def transient(self, error):
+        # transport failures (dropped or refused connections, socket and read timeouts), not e.g. bad URLs or missing files
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        from requests.exceptions import ConnectionError as RequestsConnectionError, Timeout, ChunkedEncodingError
+        return isinstance(error, (RequestsConnectionError, Timeout, ChunkedEncodingError))
+
+    def rate_limited(self, error):
+        # quota errors: 429, or a 403 with a rate limit reason
+        status, content = self.status(error)
+        if status == 429:
+            return True
+        if status == 403:
+            try:
+                reasons = {e.get('reason') for e in json.loads(content)['error']['errors']}
+            except Exception:
+                return False
+            return bool(reasons & self.RATE_LIMIT_REASONS)
+
+        return False
+
+    def retryable(self, error):
+        status, content = self.status(error)
+        if status is None:
+            return self.transient(error)
+
+        return status >= 500 or self.rate_limited(error)
+
+    def backoff_delay(self, attempt, penalize=False):
+        # only quota errors slow the bucket down, not server or connection errors
+        self.retries += 1
+        if self.metrics is not None:
+            self.metrics.count('retries')
+        if penalize:
+            self.bucket.penalize()
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def backoff(self, attempt, penalize=False):
+        time.sleep(self.backoff_delay(attempt, penalize))
+
+    def call(self, fn, *args, cost=1, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.retryable(error):
+                    raise
+                self.backoff(attempt, self.rate_limited(error))
+                attempt += 1
+                continue
+
+            self.bucket.reward()
+            return result
+
+    async def call_async(self, fn, *args, cost=1, **kwargs):
+        '''
+        call() for a coroutine function, waiting without blocking the loop.
+        '''
+        attempt = 0
+        while True:
+            await self.bucket.acquire_async(cost)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.retryable(error):
+                    raise
+                await asyncio.sleep(self.backoff_delay(attempt, self.rate_limited(error)))
+                attempt += 1
+                continue
+
+            self.bucket.reward()
+            return result
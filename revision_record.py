@@ -0,0 +1,79 @@
+# local imports
+import sys
+
+# Shared per-file fields of revisions
+class FileInfo:
+    __slots__ = ('path', 'type', 'id', 'name', 'gitignore', 'createdTime')
+
+    def __init__(self, path, type, id, name, gitignore, createdTime):
+        self.path = sys.intern(path)
+        self.type = sys.intern(type)
+        self.id = id
+        self.name = name
+        self.gitignore = gitignore
+        self.createdTime = createdTime
+
+# Compact revision record
+class Revision:
+    '''
+    One file revision as planned for a commit. Fields of the file are shared
+    through one FileInfo, authors through an interned (name, email) table, so
+    a record costs a fraction of the equivalent dict. Item access (r['path'],
+    r.get('rid')) still works for code written against the old dicts.
+    '''
+    __slots__ = ('file', 'rid', 'version', 'author', 'modifiedTime', 'md5Checksum', 'fileSize', 'exportLinks', 'downloadUrl')
+
+    AUTHORS = {}
+    FIELDS = ('path', 'type', 'id', 'rid', 'name', 'gitignore', 'version', 'authorName', 'authorEmail', 'createdTime',
+              'modifiedTime', 'md5Checksum', 'fileSize', 'exportLinks', 'downloadUrl')
+
+    def __init__(self, file, rid, version, authorName, authorEmail, modifiedTime, md5Checksum=None, fileSize=None, exportLinks=None, downloadUrl=None):
+        author = (authorName, authorEmail)
+        self.file = file
+        self.rid = rid
+        self.version = version
+        self.author = self.AUTHORS.setdefault(author, author)
+        self.modifiedTime = sys.intern(modifiedTime)
+        self.md5Checksum = md5Checksum
+        self.fileSize = fileSize
+        self.exportLinks = exportLinks
+        self.downloadUrl = downloadUrl
+
+    path = property(lambda self: self.file.path)
+    type = property(lambda self: self.file.type)
+    id = property(lambda self: self.file.id)
+    name = property(lambda self: self.file.name)
+    gitignore = property(lambda self: self.file.gitignore)
+    createdTime = property(lambda self: self.file.createdTime)
+    authorName = property(lambda self: self.author[0])
+    authorEmail = property(lambda self: self.author[1])
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, d, files=None):
+        '''
+        Rebuilds a record, sharing FileInfo objects through `files` (by id).
+        '''
+        files = {} if files is None else files
+        file = files.get(d['id'])
+        if file is None:
+            file = files[d['id']] = FileInfo(d['path'], d['type'], d['id'], d['name'], d['gitignore'], d['createdTime'])
+
+        return cls(file, d['rid'], d['version'], d['authorName'], d['authorEmail'], d['modifiedTime'],
+                   d.get('md5Checksum'), d.get('fileSize'), d.get('exportLinks'), d.get('downloadUrl'))
+
+    def __repr__(self):
+        return repr(self.to_dict())
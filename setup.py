@@ -9,5 +9,7 @@ setup(
     license='none',
     packages=find_packages(),
     install_requires=['google-api-python-client', 'google-auth-httplib2', 'google-auth-oauthlib', 'gitpython'],
+    # AsyncGoogleDrive (async_google_drive.py)
+    extras_require={'async': ['aiohttp']},
     keywords=['git', 'google-drive', 'google-api']
 )
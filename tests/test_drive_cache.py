@@ -0,0 +1,34 @@
+'''
+BlobCache bookkeeping: the running byte total, and eviction past max_bytes.
+
+    python -m pytest tests
+'''
+# local imports
+import os
+
+import drive_cache
+
+def add(cache, name, data):
+    with cache.writer(name, 'r') as blob:
+        blob.write(data)
+    return blob.path
+
+def test_total_follows_adds_and_evictions(tmp_path):
+    cache = drive_cache.BlobCache(str(tmp_path), max_bytes=10)
+    first = add(cache, 'a', b'1234')
+    add(cache, 'b', b'5678')
+    # the same content again takes no more room
+    add(cache, 'c', b'5678')
+    assert cache.total == 8
+    assert os.path.exists(first)
+
+    # past the cap, the least recently used blob goes
+    add(cache, 'd', b'90ab')
+    assert cache.total == 8
+    assert not os.path.exists(first)
+    assert cache.lookup('a', 'r') is None
+    assert cache.lookup('d', 'r') is not None
+
+    # and the total is read back when the cache opens again
+    cache.close()
+    assert drive_cache.BlobCache(str(tmp_path), max_bytes=10).total == 8
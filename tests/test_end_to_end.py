@@ -0,0 +1,198 @@
+'''
+End-to-end conversions against fake_drive.FakeDrive: every crawl and commit
+path must give the same history as the plain one, and sync_repo must catch
+up with what changed on Drive.
+
+    python -m pytest tests
+'''
+# local imports
+import io
+import os
+import contextlib
+import subprocess
+
+import pytest
+
+import fake_drive
+import drive_cache
+import drive2git
+
+CONFIG = {'name': 'Test', 'email': 'test@example.com', 'tz': 'UTC'}
+
+def fake():
+    # the same tree on every call
+    return fake_drive.FakeDrive(folders=6, files=3, revisions=3, shortcuts=3)
+
+def git(path, *args):
+    return subprocess.run(['git', '-C', path, *args], capture_output=True, text=True, check=True).stdout
+
+def convert(local_path, fk, use_async=False, make_options={}, **options):
+    '''
+    make_repo of `fk` into `local_path`, returns the Drive2Git and its repository path.
+    '''
+    drive = fk.google_drive()
+    async_drive = fk.async_google_drive(drive) if use_async else None
+    with contextlib.redirect_stdout(io.StringIO()):
+        g = drive2git.Drive2Git(drive, fk.root_id, local_path=str(local_path), config=CONFIG, async_drive=async_drive, **options)
+        g.make_repo(**make_options)
+
+    return g, os.path.join(str(local_path), g.name)
+
+def sync(local_path, fk, **options):
+    with contextlib.redirect_stdout(io.StringIO()):
+        g = drive2git.Drive2Git(fk.google_drive(), fk.root_id, local_path=str(local_path), config=CONFIG, crawl=False)
+        g.sync_repo(**options)
+
+    return g, os.path.join(str(local_path), g.name)
+
+def text_files(fk):
+    # text files at one path each, not shortcut targets (which sync_repo keeps where they were)
+    targets = {item['shortcutDetails']['targetId'] for item in fk.items.values() if 'shortcutDetails' in item}
+    return [i for i in fk.history if fk.items[i]['mimeType'] == 'text/plain' and i not in targets]
+
+def edit(fk):
+    # a bit of everything sync_repo handles: edits, a new file, a trashed file, a move
+    files = text_files(fk)
+    folders = [i for i, item in fk.items.items() if item['mimeType'] == fake_drive.FOLDER and i != fk.root_id]
+    fk.modify(files[0])
+    fk.modify(files[1])
+    fk.add_file('new.txt', folders[0], revisions=2)
+    fk.trash(files[2])
+    fk.move(files[3], folders[-1], title='moved.txt')
+
+@pytest.fixture(scope='module')
+def reference(tmp_path_factory):
+    g, repo = convert(tmp_path_factory.mktemp('reference'), fake())
+    return g.folder_map, git(repo, 'rev-parse', 'HEAD')
+
+@pytest.mark.parametrize('options', [
+    {'workers': 4},
+    {'listing': 'corpus'},
+    {'use_async': True},
+    {'use_async': True, 'listing': 'corpus', 'make_options': {'prefetch': 2}},
+    {'make_options': {'prefetch': 2, 'download_workers': 3}},
+    {'make_options': {'prefetch': 2, 'max_inflight_bytes': 4096}},
+    {'make_options': {'backend': 'fast-import'}},
+    {'make_options': {'backend': 'fast-import', 'prefetch': 2}},
+], ids=['parallel', 'corpus', 'async', 'async-corpus-prefetch', 'prefetch', 'prefetch-spill', 'fast-import', 'fast-import-prefetch'])
+def test_same_history(tmp_path, reference, options):
+    g, repo = convert(tmp_path, fake(), **options)
+    assert g.folder_map == reference[0]
+    assert git(repo, 'rev-parse', 'HEAD') == reference[1]
+
+def test_same_history_spooled(tmp_path, reference):
+    # a spooled crawl has no folder_map
+    g, repo = convert(tmp_path, fake(), spool=str(tmp_path / 'spool.sqlite'))
+    assert g.folder_map is None
+    assert git(repo, 'rev-parse', 'HEAD') == reference[1]
+
+def test_async_blob_cache_streams(tmp_path, reference, monkeypatch):
+    # downloads go to the blob cache chunk by chunk, only API responses are read whole
+    read = fake_drive.FakeAsyncResponse.read
+    async def api_only(self):
+        assert self.data[:1] in (b'{', b'')
+        return await read(self)
+    monkeypatch.setattr(fake_drive.FakeAsyncResponse, 'read', api_only)
+
+    cache = drive_cache.BlobCache(str(tmp_path / 'blobs'))
+    for run in ['miss', 'hit']:
+        fk = fake()
+        drive = fk.google_drive(blob_cache=cache)
+        with contextlib.redirect_stdout(io.StringIO()):
+            g = drive2git.Drive2Git(drive, fk.root_id, local_path=str(tmp_path / run), config=CONFIG, async_drive=fk.async_google_drive(drive))
+            g.make_repo(prefetch=2, max_inflight_bytes=4096)
+
+        assert git(os.path.join(str(tmp_path / run), g.name), 'rev-parse', 'HEAD') == reference[1]
+        assert g.metrics.counters[f'cache.blob.{run}'] > 0
+
+@pytest.mark.parametrize('use_async, make_options', [
+    (False, {}),
+    (True, {}),
+    (False, {'prefetch': 2}),
+    (False, {'backend': 'fast-import'}),
+], ids=['plain', 'async', 'prefetch', 'fast-import'])
+def test_expired_links(tmp_path, reference, use_async, make_options):
+    # the links listed by the crawl have expired by the time make_repo downloads
+    fk = fake()
+    drive = fk.google_drive()
+    async_drive = fk.async_google_drive(drive) if use_async else None
+    with contextlib.redirect_stdout(io.StringIO()):
+        g = drive2git.Drive2Git(drive, fk.root_id, local_path=str(tmp_path), config=CONFIG, async_drive=async_drive)
+        fk.expire_links()
+        g.make_repo(**make_options)
+
+    assert git(os.path.join(str(tmp_path), g.name), 'rev-parse', 'HEAD') == reference[1]
+    assert g.metrics.counters['download.stale_links'] > 0
+
+@pytest.mark.parametrize('backend', ['index', 'fast-import'])
+def test_resume(tmp_path, reference, backend):
+    fk = fake()
+    drive = fk.google_drive()
+    downloads = {'index': 'stream_file_v2', 'fast-import': 'iter_file_v2'}[backend]
+    download = getattr(drive, downloads)
+    calls = []
+    def crash(f, *args, **kwargs):
+        calls.append(f['id'])
+        if len(calls) == 10:
+            raise KeyboardInterrupt
+        return download(f, *args, **kwargs)
+    setattr(drive, downloads, crash)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        g = drive2git.Drive2Git(drive, fk.root_id, local_path=str(tmp_path), config=CONFIG)
+        with pytest.raises(KeyboardInterrupt):
+            g.make_repo(backend=backend, checkpoint=3)
+        g = drive2git.Drive2Git(fake().google_drive(), fk.root_id, local_path=str(tmp_path), config=CONFIG, crawl=False)
+        g.make_repo(backend=backend, resume=True, checkpoint=3)
+
+    assert git(os.path.join(str(tmp_path), g.name), 'rev-parse', 'HEAD') == reference[1]
+    assert not os.path.exists(g.journal_path())
+
+def test_sync_matches_new_conversion(tmp_path):
+    fk = fake()
+    convert(tmp_path / 'synced', fk)
+    edit(fk)
+    g, synced = sync(tmp_path / 'synced', fk)
+    _, converted = convert(tmp_path / 'converted', fk)
+
+    assert git(synced, 'ls-tree', '-r', 'HEAD') == git(converted, 'ls-tree', '-r', 'HEAD')
+    assert git(synced, 'status', '--short') == ''
+
+def test_sync_prefetch(tmp_path):
+    # prefetched bundles are numbered from the sync's first commit, not the repository's
+    heads = []
+    for prefetch in [0, 2]:
+        fk = fake()
+        convert(tmp_path / str(prefetch), fk)
+        edit(fk)
+        _, repo = sync(tmp_path / str(prefetch), fk, prefetch=prefetch)
+        heads.append(git(repo, 'rev-parse', 'HEAD'))
+
+    assert heads[0] == heads[1]
+
+def test_sync_keeps_edits_made_during_crawl(tmp_path):
+    # a file edited after its revisions were listed, but before another file's newer revision was
+    fk = fake()
+    files = text_files(fk)
+    revisions_list = fk.revisions_list
+    edited = []
+    def edit_once(fileId, **kwargs):
+        revisions = revisions_list(fileId, **kwargs)
+        if not edited and fileId in files:
+            edited.extend([fileId, next(i for i in files if i != fileId)])
+            for i in edited:
+                fk.modify(i)
+        return revisions
+    fk.revisions_list = edit_once
+
+    convert(tmp_path, fk)
+    fk.revisions_list = revisions_list
+    g, repo = sync(tmp_path, fk)
+
+    state = g.load_state()
+    for i in edited:
+        head = fk.history[i][-1]
+        path = os.path.relpath(state['files'][i]['path'], g.name).replace(os.sep, '/')
+        content = subprocess.run(['git', '-C', repo, 'show', f'HEAD:{path}'], capture_output=True, check=True).stdout
+        assert content == fk.content(i, head['id'], int(head['fileSize']))
+        assert state['files'][i]['rid'] == head['id']
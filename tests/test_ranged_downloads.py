@@ -0,0 +1,85 @@
+'''
+GoogleDrive.download_ranges_v2 on fake_drive.FakeDrive: resuming after a
+failed part, restarting when part_size changes, discarding on a checksum
+mismatch.
+
+    python -m pytest tests
+'''
+# local imports
+import os
+import json
+
+import pytest
+
+import fake_drive
+
+PART_SIZE = 1000
+
+def setup(tmp_path):
+    fk = fake_drive.FakeDrive(folders=1, files=1, revisions=1, docs=0, shortcuts=0, file_size=10000)
+    drive = fk.google_drive(range_threshold=1, part_size=PART_SIZE, part_workers=2, partial_dir=str(tmp_path / 'partial'))
+    i = next(iter(fk.history))
+    revision = drive.get_revisions_v2(i)[-1]
+    f = {**revision, 'id': i, 'rid': revision['id'], 'type': 'text/plain'}
+    return fk, drive, f
+
+def record_ranges(drive, fail_at=None):
+    # start of each range requested; the `fail_at` one fails, as a non-retryable error
+    starts = []
+    def recorded(url, start, end):
+        if start == fail_at:
+            raise RuntimeError('injected failure')
+        starts.append(start)
+        return type(drive).get_range(drive, url, start, end)
+    drive.get_range = recorded
+    return starts
+
+def partial_state(drive, f):
+    with open(os.path.join(drive.partial_dir, f'{f["id"]}-{f["rid"]}.partial.json')) as state:
+        return json.load(state)
+
+def test_resume_fetches_missing_parts_only(tmp_path):
+    fk, drive, f = setup(tmp_path)
+    size = int(f['fileSize'])
+    out = str(tmp_path / 'out')
+
+    record_ranges(drive, fail_at=4 * PART_SIZE)
+    with pytest.raises(RuntimeError):
+        drive.download_ranges_v2(f, out)
+    done = partial_state(drive, f)['done']
+    assert 4 not in done
+
+    starts = record_ranges(drive)
+    assert drive.download_ranges_v2(f, out) == f['md5Checksum']
+    assert sorted(starts) == [n * PART_SIZE for n in range(-(-size // PART_SIZE)) if n not in done]
+    with open(out, 'rb') as downloaded:
+        assert downloaded.read() == fk.content(f['id'], f['rid'], size)
+    assert os.listdir(drive.partial_dir) == []
+
+def test_part_size_change_restarts(tmp_path):
+    fk, drive, f = setup(tmp_path)
+    size = int(f['fileSize'])
+    out = str(tmp_path / 'out')
+
+    record_ranges(drive, fail_at=4 * PART_SIZE)
+    with pytest.raises(RuntimeError):
+        drive.download_ranges_v2(f, out)
+    assert partial_state(drive, f)['done']
+
+    # parts of another size don't line up: every part is fetched again
+    drive.part_size = 700
+    starts = record_ranges(drive)
+    assert drive.download_ranges_v2(f, out) == f['md5Checksum']
+    assert sorted(starts) == list(range(0, size, 700))
+    with open(out, 'rb') as downloaded:
+        assert downloaded.read() == fk.content(f['id'], f['rid'], size)
+
+def test_checksum_mismatch_discards(tmp_path):
+    fk, drive, f = setup(tmp_path)
+    out = str(tmp_path / 'out')
+    f['md5Checksum'] = '0' * 32
+
+    with pytest.raises(IOError, match='Checksum mismatch'):
+        drive.download_ranges_v2(f, out)
+    assert not os.path.exists(out)
+    assert os.listdir(drive.partial_dir) == []
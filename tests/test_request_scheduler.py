@@ -0,0 +1,95 @@
+'''
+RequestScheduler retries: what is retried, what slows the token bucket
+down, and batch_execute sending failed sub-requests again.
+
+    python -m pytest tests
+'''
+# local imports
+import json
+import collections
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import fake_drive
+from request_scheduler import RequestScheduler, TokenBucket
+
+def http_error(status, reason):
+    content = json.dumps({'error': {'code': status, 'errors': [{'reason': reason}]}}).encode()
+    return HttpError(httplib2.Response({'status': status}), content)
+
+def scheduler():
+    # no waiting between attempts
+    return RequestScheduler(bucket=TokenBucket(rate=1000), base_delay=0)
+
+def failing(*errors):
+    # raises `errors` in turn, then succeeds
+    errors = list(errors)
+    calls = []
+    def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+    return fn, calls
+
+@pytest.mark.parametrize('error', [http_error(403, 'rateLimitExceeded'), http_error(403, 'userRateLimitExceeded'), http_error(429, 'rateLimitExceeded')])
+def test_rate_limits_retried_and_slow_down(error):
+    s = scheduler()
+    fn, calls = failing(error)
+    assert s.call(fn) == 'ok'
+    assert len(calls) == 2
+    # halved, then grown back by one success
+    assert s.bucket.rate == 1000 / 2 + s.bucket.recovery
+
+@pytest.mark.parametrize('error', [http_error(403, 'forbidden'), http_error(404, 'notFound'), FileNotFoundError('gone'), ValueError('no link')])
+def test_permanent_errors_not_retried(error):
+    s = scheduler()
+    fn, calls = failing(error)
+    with pytest.raises(type(error)):
+        s.call(fn)
+    assert len(calls) == 1
+    assert s.retries == 0
+    assert s.bucket.rate == 1000
+
+@pytest.mark.parametrize('error', [http_error(500, 'backendError'), http_error(503, 'backendError'), ConnectionError('reset'), TimeoutError('read')])
+def test_server_and_transport_errors_retried_without_slowing_down(error):
+    s = scheduler()
+    fn, calls = failing(error, error)
+    assert s.call(fn) == 'ok'
+    assert len(calls) == 3
+    assert s.retries == 2
+    assert s.bucket.rate == 1000
+
+def test_retries_give_up():
+    s = scheduler()
+    s.max_retries = 2
+    fn, calls = failing(*[http_error(503, 'backendError')] * 5)
+    with pytest.raises(HttpError):
+        s.call(fn)
+    assert len(calls) == 3
+
+def test_batch_resends_only_failed_requests():
+    fk = fake_drive.FakeDrive(folders=2, files=3)
+    drive = fk.google_drive(scheduler=scheduler())
+    ids = list(fk.history)
+    once = {ids[1]: http_error(503, 'backendError'), ids[3]: http_error(403, 'rateLimitExceeded')}
+    calls = collections.Counter()
+    revisions_list = fk.revisions_list
+    def flaky(fileId, **kwargs):
+        calls[fileId] += 1
+        if fileId in once:
+            raise once.pop(fileId)
+        if fileId == ids[4]:
+            raise http_error(403, 'forbidden')
+        return revisions_list(fileId, **kwargs)
+    fk.revisions_list = flaky
+
+    responses = drive.batch_execute([drive.service.revisions().list(fileId=i) for i in ids])
+    # the 5xx and the rate limit are sent again, the forbidden one only once and left out
+    assert calls == {i: 2 if i in (ids[1], ids[3]) else 1 for i in ids}
+    assert [r is None for r in responses] == [i == ids[4] for i in ids]
+    assert fk.calls['batch'] == 2
+    # only the rate limit slowed the bucket down
+    assert drive.scheduler.bucket.rate < 1000